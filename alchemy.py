@@ -1,7 +1,7 @@
 """INSPIRE Absolute BFE Calculator - Computed binding free energy estimates with alchemical methods
 
 Usage:
-  alchemy.py -i=<STRUCTURES> -n=<NANOSECONDS> -l=<NUM_LAMBDA>
+  alchemy.py -i=<STRUCTURES> -n=<NANOSECONDS> -l=<NUM_LAMBDA> [-j=<WORKERS>] [--mpi] [--assign=<MODE>] [--cutoff=<NM>] [--pocket=<NM>] [-x] [-c=<ITERATIONS>]
   alchemy.py (-h | --help)
   alchemy.py --version
 
@@ -11,6 +11,14 @@ Options:
   -i=<STRUCTURES>   Path to files containing AMBER format topology and coordinates of the protein, ligand and complex.
   -n=<NANOSECONDS>  Trajectory length of simulation to run.
   -l=<NUM_LAMBDA>   Number of interpolation points between the ligand-protein complex and the protein alone.
+  -j=<WORKERS>      Number of processes running lambda windows concurrently [default: 1].
+  --mpi             Run the lambda windows over the MPI ranks instead (mpiexec -np N python alchemy.py ...).
+  --assign=<MODE>   How windows are split when there are more windows than workers: cyclic or block [default: cyclic].
+  --cutoff=<NM>     Cutoff (with a 0.1 nm switch) for the alchemical ligand-protein interactions. By default all pairs interact.
+  --pocket=<NM>     Only protein atoms within this distance of the docked ligand interact with it alchemically.
+  -x                Hamiltonian replica exchange between neighboring lambda windows (single process, or with --mpi).
+  -c=<ITERATIONS>   Checkpoint every this many iterations (2 ps each) and resume from the checkpoints
+                    when restarted with the same options, 0 to turn off [default: 100].
 """
 # TODO: needs a way to input the number of lambdas/array and the ns of simulation
 from docopt import docopt
@@ -25,8 +33,13 @@ if __name__ == '__main__':
     niter = round(500 * float(arguments['-n']))
     nlambda = int(arguments['-l'])
     
-    interface_functions.RunAlchemy(path,niter,nsteps_per_iter,nlambda)
-    with open(f'{path}/alchemical.log',"w+") as logf:
-        logf.write("Execution time (sec): {}\n".format(timeit.default_timer() - start))
+    cutoff = float(arguments['--cutoff']) if arguments['--cutoff'] is not None else None
+    pocket = float(arguments['--pocket']) if arguments['--pocket'] is not None else None
+    result = interface_functions.RunAlchemy(path,niter,nsteps_per_iter,nlambda,
+                                            int(arguments['-j']),arguments['--assign'],arguments['--mpi'],
+                                            cutoff,pocket,arguments['-x'],int(arguments['-c']))
+    if result is not None:
+        with open(f'{path}/alchemical.log',"w+") as logf:
+            logf.write("Execution time (sec): {}\n".format(timeit.default_timer() - start))
 
 
@@ -0,0 +1,121 @@
+"""INSPIRE Benchmarks - Time the hot spots of the pipeline
+
+Usage:
+  benchmark.py dock -s=<SMILES_FILE> [-i=<RECEPTOR>] [-n=<NUM>]
+  benchmark.py platforms -p=<STRUCTURES> [--steps=<STEPS>]
+  benchmark.py alchemy -p=<STRUCTURES> [--steps=<STEPS>] [--cutoff=<NM>] [--pocket=<NM>]
+  benchmark.py (-h | --help)
+
+Options:
+  -h --help          Show this screen.
+  -s=<SMILES_FILE>   Space separated file with a SMILES in the first column (same format as runner.py).
+  -i=<RECEPTOR>      Receptor oeb to dock into [default: input/receptor.oeb].
+  -n=<NUM>           Number of ligands to time [default: 10].
+  -p=<STRUCTURES>    Directory with com.prmtop and com.inpcrd (output of param.py).
+  --steps=<STEPS>    MD steps timed per platform or setup [default: 5000].
+  --cutoff=<NM>      Alchemical cutoff for the alchemy benchmark [default: 1.0].
+  --pocket=<NM>      Pocket radius for the alchemy benchmark [default: 1.5].
+
+dock: per-ligand docking latency with and without the receptor cache of dock_conf.DockConf.
+      Conformers are generated beforehand so only DockConf is timed.
+platforms: GB MD throughput of the complex on every OpenMM platform available, with the
+      presets of impress_md.platforms (IMPRESS_PRECISION, IMPRESS_THREADS, ...).
+alchemy: steps/s of the alchemical complex with the all-pairs alchemical force, with a cutoff,
+      and with a cutoff plus a pocket restricted interaction group.
+"""
+from docopt import docopt
+import timeit
+
+
+def read_smiles(filename, num):
+    smiles = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].upper() == 'SMILES':
+                continue
+            smiles.append(fields[0])
+            if len(smiles) == num:
+                break
+    return smiles
+
+
+def report(name, times):
+    import numpy as np
+    times = np.array(times)
+    print("{:<20s} n={:<5d} mean={:.4f}s median={:.4f}s total={:.2f}s".format(
+        name, len(times), times.mean(), np.median(times), times.sum()))
+
+
+def bench_dock(smiles_file, receptor, num):
+    from impress_md import conf_gen, dock_conf
+    confs = []
+    for smiles in read_smiles(smiles_file, num):
+        mols = conf_gen.FromString(smiles)
+        if mols:
+            confs.append(conf_gen.SelectEnantiomer(mols))
+
+    for name, use_cache in [('no cache', False), ('receptor cache', True)]:
+        dock_conf.ClearDockCache()
+        times = []
+        for mol in confs:
+            t = timeit.default_timer()
+            dock_conf.DockConf(receptor, mol, MAX_POSES=1, use_cache=use_cache)
+            times.append(timeit.default_timer() - t)
+        report(name, times)
+
+
+def bench_platforms(path, nsteps):
+    from simtk.openmm import app
+    import simtk.openmm as mm
+    from simtk import unit
+    from impress_md import platforms
+    prmtop = app.AmberPrmtopFile(f'{path}/com.prmtop')
+    inpcrd = app.AmberInpcrdFile(f'{path}/com.inpcrd')
+    for name in platforms.AvailablePlatforms():
+        system = prmtop.createSystem(implicitSolvent=app.GBn2,
+                                     nonbondedMethod=app.CutoffNonPeriodic,
+                                     nonbondedCutoff=1.0*unit.nanometers,
+                                     constraints=app.HBonds)
+        integrator = mm.LangevinIntegrator(300*unit.kelvin, 1.0/unit.picoseconds, 2.0*unit.femtoseconds)
+        platform, properties = platforms.GetPlatform(name)
+        simulation = app.Simulation(prmtop.topology, system, integrator, platform, properties)
+        simulation.context.setPositions(inpcrd.positions)
+        simulation.step(10) # warm up, kernels are compiled on first use
+        simulation.context.getState(getEnergy=True)
+        t = timeit.default_timer()
+        simulation.step(nsteps)
+        simulation.context.getState(getEnergy=True)
+        elapsed = timeit.default_timer() - t
+        ns_per_day = nsteps * 2e-6 / elapsed * 86400
+        print("{:<20s} {:.1f} steps/s {:.2f} ns/day".format(platforms.last_used, nsteps / elapsed, ns_per_day))
+        del simulation
+
+
+def bench_alchemy(path, nsteps, cutoff, pocket):
+    from simtk import unit
+    from impress_md import alchemy
+    setups = [('all pairs', None, None),
+              ('cutoff {}'.format(cutoff), cutoff*unit.nanometers, None),
+              ('cutoff {} pocket {}'.format(cutoff, pocket), cutoff*unit.nanometers, pocket*unit.nanometers)]
+    for name, c, p in setups:
+        simulation = alchemy.BuildSimulation(path, c, p)
+        simulation.context.setParameter('lambda', 0.5)
+        simulation.step(10)
+        simulation.context.getState(getEnergy=True)
+        t = timeit.default_timer()
+        simulation.step(nsteps)
+        simulation.context.getState(getEnergy=True)
+        elapsed = timeit.default_timer() - t
+        print("{:<30s} {:.1f} steps/s".format(name, nsteps / elapsed))
+        del simulation
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if arguments['dock']:
+        bench_dock(arguments['-s'], arguments['-i'], int(arguments['-n']))
+    elif arguments['platforms']:
+        bench_platforms(arguments['-p'], int(arguments['--steps']))
+    elif arguments['alchemy']:
+        bench_alchemy(arguments['-p'], int(arguments['--steps']), float(arguments['--cutoff']), float(arguments['--pocket']))
@@ -1,7 +1,8 @@
 """INSPIRE Docking - Put a ligand (SMILES) in a protein (PDB)
 
 Usage:
-  docking.py -s=<SMILES> -o=<PATH> -i=<PATH>
+  docking.py -s=<SMILES> -o=<PATH> -i=<PATH> [-c=<STORE>] [-m=<MB>]
+  docking.py -f=<SMILES_FILE> -o=<PATH> -i=<PATH> [-b=<BATCH>] [-j=<WORKERS>] [-q=<DEPTH>] [-c=<STORE>] [-m=<MB>]
   docking.py (-h | --help)
   docking.py --version
 
@@ -12,9 +13,19 @@ Options:
   -i=<PATH>     Path to PDB or OEB file containing protein target for docking.
                 The openeye binary (OEB) can be precompiled to speed up docking time.
   -o=<PATH>     Path to write output.
+  -f=<SMILES_FILE>  Dock every SMILES in a space separated .smi file. All poses go to
+                    <PATH>/poses.oeb.gz and all scores to <PATH>/scores.csv.
+  -b=<BATCH>    Number of ligands written per batch in file mode [default: 1000].
+  -j=<WORKERS>  Processes generating conformers ahead of docking in file mode, 0 = inline [default: 0].
+  -q=<DEPTH>    Number of ligands queued for conformer generation in file mode [default: 8].
+  -c=<STORE>    Conformer store (directory of OEB files) reused across screens, by any number of nodes.
+                Created if missing.
+  -m=<MB>       Size limit of the conformer store; least recently used ensembles are evicted beyond it.
+                Defaults to $IMPRESS_CONF_STORE_MAX, unbounded if that is unset.
 """
 from docopt import docopt
 from impress_md import interface_functions
+import os
 import timeit
 start = timeit.default_timer()
 
@@ -24,8 +35,15 @@ if __name__ == '__main__':
     struct = arguments['-i']
     
     path = arguments['-o']
+    if arguments['-m'] is not None:
+        # Through the environment, so the conformer pool workers get it too
+        os.environ['IMPRESS_CONF_STORE_MAX'] = arguments['-m']
 
-    interface_functions.RunDocking(smiles,struct,path)
+    if arguments['-f'] is not None:
+        interface_functions.RunDockingBatch(arguments['-f'], struct, path, int(arguments['-b']),
+                                            int(arguments['-j']), int(arguments['-q']), arguments['-c'])
+    else:
+        interface_functions.RunDocking(smiles,struct,path,conf_store=arguments['-c'])
     docked_time = timeit.default_timer()
 
 with open(f'{path}/docking.log',"w+") as logf:
@@ -1,17 +1,46 @@
+import os
 from simtk.openmm import app
 import simtk.openmm as mm
 from simtk import unit
+from . import platforms, checkpoint, timing
 
-def AddAlchemyForces(system, ligand_ind):
+# The alchemical force has a force group of its own, so the lambda independent part of the energy
+#   can be evaluated once per sample and only this group once per lambda state.
+ALCHEMICAL_GROUP = 1
+OTHER_GROUPS = set(range(32)) - {ALCHEMICAL_GROUP}
+
+def PocketAtoms(positions, ligand, protein, radius):
+    """
+    Returns the atoms of protein within radius of any ligand atom.
+    """
+    import numpy as np
+    xyz = np.array(positions.value_in_unit(unit.nanometers))
+    protein = sorted(protein)
+    lig_xyz = xyz[sorted(ligand)]
+    r2 = radius.value_in_unit(unit.nanometers)**2
+    near = set()
+    # Chunked so the distance matrix stays small for large receptors
+    for start in range(0, len(protein), 4096):
+        chunk = protein[start:start+4096]
+        d2 = ((xyz[chunk][:,None,:] - lig_xyz[None,:,:])**2).sum(axis=2).min(axis=1)
+        near.update(atm for atm, d in zip(chunk, d2) if d <= r2)
+    return near
+
+def AddAlchemyForces(system, ligand_ind, cutoff=None, switch_width=0.1*unit.nanometers, pocket=None, positions=None):
     """
     Input an OpenMM 'system' object and the indices of the ligand
     No output. Function adds alchemical nonbonded forces to the system
+    By default the alchemical force sums over all ligand-protein pairs (NoCutoff).
+    cutoff: use CutoffNonPeriodic at this distance instead, switched off over the last switch_width.
+    pocket: only protein atoms within this distance of the ligand at positions interact with it.
     """
     forces = {force.__class__.__name__ : force for force in system.getForces()}
     nbforce = forces['NonbondedForce']
     
     ligand  = ligand_ind
     protein = set(range(system.getNumParticles())) - ligand
+    if pocket is not None:
+        protein = PocketAtoms(positions, ligand, protein, pocket)
     
     alchemical_energy  = 'lambda*4*epsilon*x*(x-1.0); x = (sigma/reff_sterics)^6;'
     alchemical_energy += 'reff_sterics = sigma*(0.5*(1.0-lambda) + (r/sigma)^6)^(1/6);'
@@ -29,11 +58,23 @@ def AddAlchemyForces(system, ligand_ind):
             # TODO: Not actually sure which '*0' options are necessary
             nbforce.setParticleParameters(atm, charge*0, sigma, epsilon)
     alchemical_force.addInteractionGroup(ligand,protein)
+    if cutoff is not None:
+        alchemical_force.setNonbondedMethod(mm.CustomNonbondedForce.CutoffNonPeriodic)
+        alchemical_force.setCutoffDistance(cutoff)
+        if switch_width is not None:
+            alchemical_force.setUseSwitchingFunction(True)
+            alchemical_force.setSwitchingDistance(cutoff - switch_width)
+    alchemical_force.setForceGroup(ALCHEMICAL_GROUP)
     system.addForce(alchemical_force)    
     
-def SimulateAlchemy(path, niter, nsteps_per_iter, nlambda):
-    """Calculates the binding free energy of a ligand names 'UNL' using alchemy.
-    One step corresponds to two femtoseconds.
+def LigandIndices(topology):
+    # OpenEye make the ligand name 'UNL'
+    return set(atm.index for atm in topology.atoms() if atm.residue.name == 'UNL')
+
+def BuildSimulation(path, cutoff=None, pocket=None):
+    """
+    Returns a minimized Simulation of the complex in path with the alchemical forces added.
+    cutoff and pocket are passed on to AddAlchemyForces.
     """
     prmtop = app.AmberPrmtopFile(f'{path}/com.prmtop')
     inpcrd = app.AmberInpcrdFile(f'{path}/com.inpcrd')
@@ -45,44 +86,103 @@ def SimulateAlchemy(path, niter, nsteps_per_iter, nlambda):
                                  ewaldErrorTolerance=0.0005)
     
     # Detect ligand indices
-    ligand_ind = []
-    for atm in prmtop.topology.atoms():
-        # OpenEye make the ligand name 'UNL'
-        if atm.residue.name == 'UNL':
-            ligand_ind.append(atm.index)
-    ligand_ind = set(ligand_ind)
-    AddAlchemyForces(system, ligand_ind)
+    AddAlchemyForces(system, LigandIndices(prmtop.topology), cutoff=cutoff, pocket=pocket, positions=inpcrd.positions)
     
     integrator = mm.LangevinIntegrator(300*unit.kelvin,
                                        1.0/unit.picoseconds,
                                        2.0*unit.femtoseconds)
     integrator.setConstraintTolerance(0.00001)
-    # TODO: The issues here are the same as the mmgbsa.py script
-    # TODO: This should just recognize whatever the computer is capable of, not force CUDA.
     # TODO: I am not sure if mixed precision is necessary. Just need to be consistent
-    platform = mm.Platform.getPlatformByName('CUDA')
-    properties = {'CudaPrecision': 'mixed'}
-    simulation = app.Simulation(prmtop.topology, system, integrator, platform)
+    platform, properties = platforms.GetPlatform()
+    simulation = app.Simulation(prmtop.topology, system, integrator, platform, properties)
     simulation.context.setPositions(inpcrd.positions)
     simulation.minimizeEnergy()
+    return simulation
 
-    ### Now simulate system
+def SampleWindow(simulation, k, lambdas, niter, nsteps_per_iter, checkpoint_file=None, checkpoint_interval=0):
+    """
+    Samples lambda state k and returns its row of u_kln: the reduced energy of every sample
+    in every lambda state, shape [nlambda, niter].
+    Every checkpoint_interval iterations the row and the simulation state are saved to checkpoint_file.
+      If that file already holds a checkpoint of the same run, sampling continues from it.
+    """
+    import numpy as np
+    nlambda = len(lambdas)
+    u_ln = np.zeros([nlambda, niter])
+    kT = KT(simulation)
+    start = 0
+    if checkpoint_file is not None:
+        saved = checkpoint.Load(checkpoint_file, niter=niter, nlambda=nlambda, nsteps_per_iter=nsteps_per_iter)
+        if saved is not None:
+            u_ln = saved['u_ln']
+            start = int(saved['iteration'])
+            simulation.context.setState(saved['states']['window'])
+    for i in range(start, niter):
+        print('state %5d iteration %5d / %5d' % (k, i, niter))
+        simulation.context.setParameter('lambda',lambdas[k])
+        with timing.Span('md_steps', steps=nsteps_per_iter):
+            simulation.integrator.step(nsteps_per_iter)
+        with timing.Span('energy_readback'):
+            u_ln[:,i] = ReducedEnergies(simulation, lambdas, kT)
+        if checkpoint_file is not None and checkpoint.Due(i+1, checkpoint_interval, niter):
+            state = simulation.context.getState(getPositions=True, getVelocities=True, getParameters=True)
+            checkpoint.Save(checkpoint_file, {'window': state}, u_ln=u_ln, iteration=i+1,
+                            niter=niter, nlambda=nlambda, nsteps_per_iter=nsteps_per_iter)
+    return u_ln
+
+def KT(simulation):
+    return unit.AVOGADRO_CONSTANT_NA * unit.BOLTZMANN_CONSTANT_kB * simulation.integrator.getTemperature()
+
+def ReducedEnergies(simulation, lambdas, kT):
+    """
+    Reduced potential energy of the current configuration in every lambda state.
+    """
+    import numpy as np
+    u_l = np.zeros([len(lambdas)])
+    other = simulation.context.getState(getEnergy=True, groups=OTHER_GROUPS).getPotentialEnergy()
+    for l in range(len(lambdas)):
+        simulation.context.setParameter('lambda',lambdas[l])
+        alchemical = simulation.context.getState(getEnergy=True, groups={ALCHEMICAL_GROUP}).getPotentialEnergy()
+        u_l[l] = (other + alchemical) / kT
+    return u_l
+
+def WindowCheckpoint(path, k):
+    return f'{path}/alchemy_window{k}.chk.npz'
+
+def SimulateWindows(path, windows, niter, nsteps_per_iter, nlambda, cutoff=None, pocket=None, checkpoint_interval=0):
+    """
+    Builds one Simulation and samples the given lambda states with it, one after another.
+    Returns {k: u_kln[k]}.
+    With checkpoint_interval > 0 every window checkpoints to path/alchemy_window<k>.chk.npz
+      (see SampleWindow); finished windows are then read back instead of simulated again.
+    """
     import numpy as np
-    from pymbar import MBAR, timeseries
     lambdas = np.linspace(1.0, 0.0, nlambda)
-    # Save the potential energies for MBAR
-    u_kln = np.zeros([nlambda, nlambda, niter])
-    kT = unit.AVOGADRO_CONSTANT_NA * unit.BOLTZMANN_CONSTANT_kB * integrator.getTemperature()
-    # TODO: This runs in series. Someone comfortable with MPI should help parallelize this.
-    for k in range(nlambda):
-        for i in range(niter):
-            print('state %5d iteration %5d / %5d' % (k, i, niter))
-            simulation.context.setParameter('lambda',lambdas[k])
-            integrator.step(nsteps_per_iter)
-            for l in range(nlambda):
-                simulation.context.setParameter('lambda',lambdas[l])
-                u_kln[k,l,i] = simulation.context.getState(getEnergy=True).getPotentialEnergy() / kT
+    simulation = BuildSimulation(path, cutoff, pocket)
+    checkpoint_file = lambda k: WindowCheckpoint(path, k) if checkpoint_interval > 0 else None
+    return {k: SampleWindow(simulation, k, lambdas, niter, nsteps_per_iter, checkpoint_file(k), checkpoint_interval)
+            for k in windows}
 
+def AssignWindows(nlambda, nworkers, assignment='cyclic'):
+    """
+    Splits the lambda states over nworkers. 'cyclic' deals them out like cards (0, n, 2n, ...),
+      which mixes cheap and expensive states; 'block' gives each worker a contiguous range.
+    """
+    if assignment == 'cyclic':
+        return [list(range(w, nlambda, nworkers)) for w in range(nworkers)]
+    elif assignment == 'block':
+        import numpy as np
+        return [list(block) for block in np.array_split(np.arange(nlambda), nworkers)]
+    raise ValueError(f"Unknown window assignment {assignment}")
+
+def AnalyzeAlchemy(u_kln):
+    """
+    Subsamples every window and returns the MBAR free energy difference and its error
+    between the first and the last lambda state.
+    """
+    import numpy as np
+    from pymbar import MBAR, timeseries
+    nlambda = u_kln.shape[0]
     # Subsample to reduce variation
     N_k = np.zeros([nlambda], np.int32) # number of uncorrelated samples
     for k in range(nlambda):
@@ -97,4 +197,189 @@ def SimulateAlchemy(path, niter, nsteps_per_iter, nlambda):
     [DeltaF_ij, dDeltaF_ij, Theta_ij] = mbar.getFreeEnergyDifferences()
     return DeltaF_ij[0][-1], dDeltaF_ij[0][-1]
 
+def SimulateAlchemy(path, niter, nsteps_per_iter, nlambda, nworkers=1, assignment='cyclic', cutoff=None, pocket=None,
+                    checkpoint_interval=0):
+    """Calculates the binding free energy of a ligand names 'UNL' using alchemy.
+    One step corresponds to two femtoseconds.
+    With nworkers > 1 the lambda windows run concurrently in a process pool, each worker with its own
+      Context, and the rows of u_kln are gathered for MBAR. Every worker starts its windows from the
+      minimized complex, where the serial run carries the coordinates over from the previous window.
+    cutoff and pocket restrict the alchemical interactions (see AddAlchemyForces).
+    checkpoint_interval > 0 checkpoints every window that often (in iterations), see SimulateWindows.
+    """
+    import numpy as np
+    u_kln = np.zeros([nlambda, nlambda, niter])
+    if nworkers <= 1:
+        rows = SimulateWindows(path, range(nlambda), niter, nsteps_per_iter, nlambda, cutoff, pocket, checkpoint_interval)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        rows = {}
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            futures = [pool.submit(SimulateWindows, path, windows, niter, nsteps_per_iter, nlambda, cutoff, pocket,
+                                   checkpoint_interval)
+                       for windows in AssignWindows(nlambda, nworkers, assignment) if windows]
+            for future in futures:
+                rows.update(future.result())
+    for k, u_ln in rows.items():
+        u_kln[k] = u_ln
+    result = AnalyzeAlchemy(u_kln)
+    checkpoint.Remove(*[WindowCheckpoint(path, k) for k in range(nlambda)])
+    return result
+
+def SimulateAlchemyMPI(path, niter, nsteps_per_iter, nlambda, comm=None, assignment='cyclic', cutoff=None, pocket=None,
+                       checkpoint_interval=0):
+    """
+    SimulateAlchemy over the ranks of comm. Every rank samples its share of the lambda windows;
+      rank 0 gathers u_kln and returns the free energy, the other ranks return None.
+    """
+    import numpy as np
+    if comm is None:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    windows = AssignWindows(nlambda, comm.Get_size(), assignment)[comm.Get_rank()]
+    rows = SimulateWindows(path, windows, niter, nsteps_per_iter, nlambda, cutoff, pocket,
+                           checkpoint_interval) if windows else {}
+    gathered = comm.gather(rows, root=0)
+    if comm.Get_rank() != 0:
+        return None
+    u_kln = np.zeros([nlambda, nlambda, niter])
+    for rank_rows in gathered:
+        for k, u_ln in rank_rows.items():
+            u_kln[k] = u_ln
+    result = AnalyzeAlchemy(u_kln)
+    checkpoint.Remove(*[WindowCheckpoint(path, k) for k in range(nlambda)])
+    return result
+
+def AttemptSwaps(u_rl, states, iteration, random, accepted, attempted):
+    """
+    Metropolis swaps of neighboring lambda states, using the energies every replica already
+      computed in every state. Even pairs (0-1, 2-3, ...) are tried on even iterations and odd
+      pairs on odd ones. states[r] is the state of replica r and is updated in place;
+      accepted/attempted count per pair (k, k+1).
+    """
+    import numpy as np
+    replica_in = {k: r for r, k in enumerate(states)}
+    for k in range(iteration % 2, len(states) - 1, 2):
+        a, b = replica_in[k], replica_in[k+1]
+        delta = u_rl[a,k+1] + u_rl[b,k] - u_rl[a,k] - u_rl[b,k+1]
+        attempted[k] += 1
+        if delta <= 0 or random.rand() < np.exp(-delta):
+            states[a], states[b] = k+1, k
+            replica_in[k], replica_in[k+1] = b, a
+            accepted[k] += 1
+
+def SimulateReplicaExchange(path, niter, nsteps_per_iter, nlambda, comm=None, cutoff=None, pocket=None, seed=None,
+                            checkpoint_interval=0):
+    """
+    Hamiltonian replica exchange over the lambda states. One replica per state; every iteration each
+      replica is propagated in its current state, its energy in all states is computed (as in SampleWindow)
+      and neighboring states are swapped with AttemptSwaps. Replicas keep their coordinates and swap lambdas.
+    Without comm all replicas share one Context in this process. With an MPI comm the replicas are dealt
+      out over the ranks, rank 0 decides the swaps and broadcasts the new states.
+    With checkpoint_interval > 0 every rank saves its replicas and rank 0 the energies, states and
+      acceptance counts that often; a restart with the same settings and number of ranks resumes.
+    Returns the free energy on rank 0 (None on other ranks) and writes the acceptance rates to
+      path/exchange.log.
+    """
+    import numpy as np
+    rank = comm.Get_rank() if comm is not None else 0
+    size = comm.Get_size() if comm is not None else 1
+    lambdas = np.linspace(1.0, 0.0, nlambda)
+    replicas = AssignWindows(nlambda, size, 'cyclic')[rank]
+
+    simulation = BuildSimulation(path, cutoff, pocket)
+    kT = KT(simulation)
+    temperature = simulation.integrator.getTemperature()
+    configurations = {}
+    for r in replicas:
+        simulation.context.setVelocitiesToTemperature(temperature)
+        configurations[r] = simulation.context.getState(getPositions=True, getVelocities=True, getParameters=True)
+
+    states = list(range(nlambda))
+    random = np.random.RandomState(seed)
+    accepted = np.zeros([nlambda - 1], np.int64)
+    attempted = np.zeros([nlambda - 1], np.int64)
+    u_kln = np.zeros([nlambda, nlambda, niter])
+
+    # Rank 0's file decides which iteration to resume from; every rank keeps its previous file too,
+    #   in case a crash left the ranks one checkpoint apart.
+    master_file = f'{path}/exchange.chk.npz'
+    rank_files = [f'{path}/exchange_rank{rank}.chk.npz', f'{path}/exchange_rank{rank}.prev.chk.npz']
+    start = 0
+    if checkpoint_interval > 0:
+        master = checkpoint.Load(master_file, niter=niter, nlambda=nlambda, size=size) if rank == 0 else None
+        resume = int(master['iteration']) if master is not None else 0
+        if comm is not None:
+            resume = comm.bcast(resume, root=0)
+        local = None
+        if resume > 0:
+            local = next((saved for saved in (checkpoint.Load(f, iteration=resume) for f in rank_files)
+                          if saved is not None), None)
+        found = local is not None
+        if comm is not None:
+            found = all(comm.allgather(found))
+        if resume > 0 and found:
+            start = resume
+            configurations.update({int(r): state for r, state in local['states'].items()})
+            if len(replicas) == 1:
+                simulation.context.setState(configurations[replicas[0]])
+            if rank == 0:
+                states = [int(k) for k in master['replica_states']]
+                accepted, attempted, u_kln = master['accepted'], master['attempted'], master['u_kln']
+                random.set_state(('MT19937', master['random_keys'], int(master['random_pos'])))
+            if comm is not None:
+                states = comm.bcast(states, root=0)
+
+    for i in range(start, niter):
+        u_local = {}
+        for r in replicas:
+            print('replica %5d state %5d iteration %5d / %5d' % (r, states[r], i, niter))
+            if len(replicas) > 1:
+                simulation.context.setState(configurations[r])
+            simulation.context.setParameter('lambda',lambdas[states[r]])
+            with timing.Span('md_steps', steps=nsteps_per_iter):
+                simulation.integrator.step(nsteps_per_iter)
+            if len(replicas) > 1:
+                configurations[r] = simulation.context.getState(getPositions=True, getVelocities=True, getParameters=True)
+            with timing.Span('energy_readback'):
+                u_local[r] = ReducedEnergies(simulation, lambdas, kT)
+        if comm is not None:
+            u_all = {}
+            for part in comm.allgather(u_local):
+                u_all.update(part)
+        else:
+            u_all = u_local
+        u_rl = np.array([u_all[r] for r in range(nlambda)])
+        for r in range(nlambda):
+            u_kln[states[r],:,i] = u_rl[r]
+        if rank == 0:
+            AttemptSwaps(u_rl, states, i, random, accepted, attempted)
+        if comm is not None:
+            states = comm.bcast(states, root=0)
+
+        if checkpoint.Due(i+1, checkpoint_interval, niter) and i+1 < niter:
+            if len(replicas) == 1:
+                configurations[replicas[0]] = simulation.context.getState(getPositions=True, getVelocities=True, getParameters=True)
+            if os.path.exists(rank_files[0]):
+                os.replace(rank_files[0], rank_files[1])
+            checkpoint.Save(rank_files[0], {str(r): configurations[r] for r in replicas}, iteration=i+1)
+            if comm is not None:
+                comm.barrier()
+            if rank == 0:
+                random_state = random.get_state()
+                checkpoint.Save(master_file, u_kln=u_kln, replica_states=np.array(states), accepted=accepted,
+                                attempted=attempted, random_keys=random_state[1], random_pos=random_state[2],
+                                iteration=i+1, niter=niter, nlambda=nlambda, size=size)
 
+    if rank == 0:
+        checkpoint.Remove(master_file)
+    checkpoint.Remove(*rank_files)
+    if rank != 0:
+        return None
+    rates = accepted / np.maximum(attempted, 1)
+    with open(f'{path}/exchange.log', 'w') as log:
+        log.write("states,accepted,attempted,rate\n")
+        for k in range(nlambda - 1):
+            log.write("{}-{},{},{},{}\n".format(k, k+1, accepted[k], attempted[k], rates[k]))
+    print("Exchange acceptance rates", rates)
+    return AnalyzeAlchemy(u_kln)
@@ -0,0 +1,113 @@
+"""
+Streaming docking for whole libraries.
+Each stage is a generator, so only the current batch of ligands is ever held in memory.
+All poses go to a single multi-molecule file and all scores to a single table, instead of
+  a directory with apo.pdb, lig.pdb and metrics.csv per ligand.
+"""
+import os
+import itertools
+from openeye import oechem
+from . import conf_gen, dock_conf
+
+
+def ReadSmiles(filename, header=True):
+    """
+    Yields (row, name, smiles) from a space separated .smi file.
+    row counts data lines from 0, the same index runner.py uses with df.iloc.
+    name is the second column if there is one, otherwise the row.
+    """
+    with open(filename) as f:
+        if header:
+            next(f, None)
+        for row, line in enumerate(f):
+            fields = line.split()
+            if not fields:
+                continue
+            name = fields[1] if len(fields) > 1 else str(row)
+            yield row, name, fields[0]
+
+def GenerateConformers(ligands, isomer=True, num_enantiomers=1, workers=0, depth=8, store=None):
+    """
+    Yields (row, name, smiles, mol). mol is None when the SMILES is invalid or Omega fails.
+    With workers > 0 conformers are built in a process pool, up to depth ligands ahead of docking.
+    store is an optional conformer store path (see conf_store.py).
+    """
+    if workers > 0:
+        yield from conf_gen.PrefetchConformers(ligands, workers, depth, isomer, num_enantiomers, store)
+        return
+    for row, name, smiles in ligands:
+        confs = conf_gen.FromString(smiles, isomer, num_enantiomers, store)
+        mol = conf_gen.SelectEnantiomer(confs) if confs else None
+        yield row, name, smiles, mol
+
+def Dock(ligands, dock, receptor, MAX_POSES=1):
+    """
+    Yields (row, name, smiles, lig, score) for (row, name, smiles, mol) tuples.
+    lig and score are None for ligands without conformers.
+    """
+    for row, name, smiles, mol in ligands:
+        if mol is None:
+            yield row, name, smiles, None, None
+            continue
+        dock, lig, receptor = dock_conf.DockConfWithDock(dock, receptor, mol, MAX_POSES)
+        if lig.NumConfs() == 0:
+            yield row, name, smiles, None, None
+        else:
+            yield row, name, smiles, lig, dock_conf.BestDockScore(dock, lig)
+
+def Batches(iterable, size):
+    """
+    Splits an iterable into lists of at most size elements.
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+def WriteBatch(batch, poses, scores):
+    for row, name, smiles, lig, score in batch:
+        if lig is None:
+            scores.write("{},{},{},NA,NA\n".format(row, name, smiles))
+            continue
+        conf = oechem.OEGraphMol(list(lig.GetConfs())[0])
+        conf.SetTitle(name)
+        oechem.OESetSDData(conf, "Dock", str(score))
+        oechem.OEWriteMolecule(poses, conf)
+        scores.write("{},{},{},{},{}\n".format(row, name, smiles, score, 0))
+    scores.flush()
+    poses.flush()
+
+def RunBatchDocking(ligands, receptor_file, outpath, batch_size=1000, MAX_POSES=1,
+                    poses_name='poses.oeb.gz', scores_name='scores.csv', conf_workers=0, conf_depth=8,
+                    conf_store=None):
+    """
+    Docks an iterator of (row, name, smiles), e.g. ReadSmiles(filename), into receptor_file.
+    Writes apo.pdb once, the top pose of every ligand to outpath/poses_name and
+      one line per ligand to outpath/scores_name.
+    conf_workers, conf_depth and conf_store set up conformer generation (see GenerateConformers).
+    Returns the number of ligands processed.
+    """
+    if not os.path.exists(outpath):
+        os.mkdir(outpath)
+    dock, receptor = dock_conf.LoadDock(receptor_file)
+
+    ofs = oechem.oemolostream()
+    if ofs.open(f'{outpath}/apo.pdb'):
+        oechem.OEWriteMolecule(ofs, receptor)
+        ofs.close()
+
+    poses = oechem.oemolostream()
+    if not poses.open(f'{outpath}/{poses_name}'):
+        raise RuntimeError(f"Could not open {outpath}/{poses_name}")
+    count = 0
+    with open(f'{outpath}/{scores_name}', 'w') as scores:
+        scores.write("row,name,smiles,Dock,Dock_U\n")
+        confs = GenerateConformers(ligands, workers=conf_workers, depth=conf_depth, store=conf_store)
+        docked = Dock(confs, dock, receptor, MAX_POSES)
+        for batch in Batches(docked, batch_size):
+            WriteBatch(batch, poses, scores)
+            count += len(batch)
+    poses.close()
+    return count
@@ -0,0 +1,150 @@
+"""
+Partial charges for parameterization, with a persistent cache and a process pool.
+AM1-BCC charging dominates the cost of ParameterizeOE and the same molecules come back in every
+  rescreen, so charges are kept in a SQLite file keyed by the canonical isomeric SMILES and the
+  charge method. They are stored in canonical atom order with the atomic numbers, so they can be
+  mapped onto any input order of the same molecule (e.g. the atoms of a docked lig.pdb).
+Caching is opt-in: set $IMPRESS_CHARGE_CACHE to the cache file, an absolute path shared by every
+  rank, so separate runs neither share nor scatter cache files by accident.
+The file uses SQLite's rollback journal, not WAL: WAL keeps its index in shared memory, which ranks
+  on different nodes do not share. The rollback journal relies on POSIX file locks, so a file shared
+  by several nodes must be on a filesystem where those work (e.g. Lustre mounted with flock, GPFS);
+  otherwise give each node its own file, e.g. on node-local storage.
+"""
+import os
+import io
+import sqlite3
+import hashlib
+from collections import deque
+import numpy as np
+from openeye import oechem, oequacpac
+from . import timing
+
+METHODS = {'am1bcc': oequacpac.OEAM1BCCCharges,
+           'am1bccelf10': oequacpac.OEAM1BCCELF10Charges}
+
+# Open caches, one per path and process (see Default).
+_caches = {}
+
+def ChargeKey(mol, method):
+    canonical = oechem.OECreateIsoSmiString(oechem.OEGraphMol(mol))
+    return hashlib.sha1(f'{canonical} method={method}'.encode()).hexdigest(), canonical
+
+def CanonicalOrder(mol):
+    """
+    Returns the indices of the atoms of mol in canonical order. mol itself is not reordered.
+    """
+    copy = oechem.OEGraphMol(mol)
+    for atom in copy.GetAtoms():
+        atom.SetIntData('input_idx', atom.GetIdx())
+    oechem.OECanonicalOrderAtoms(copy)
+    return [atom.GetIntData('input_idx') for atom in copy.GetAtoms()]
+
+class ChargeCache():
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS charges (key TEXT PRIMARY KEY, smiles TEXT, method TEXT, data BLOB)')
+
+    def get(self, mol, method):
+        """
+        Returns the cached charges of mol in its own atom order, or None on a miss.
+        """
+        key, canonical = ChargeKey(mol, method)
+        row = self.conn.execute('SELECT data FROM charges WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        saved = np.load(io.BytesIO(row[0]))
+        order = CanonicalOrder(mol)
+        atoms = list(mol.GetAtoms())
+        numbers = [atoms[i].GetAtomicNum() for i in order]
+        if len(numbers) != len(saved['atomic_numbers']) or np.any(np.array(numbers) != saved['atomic_numbers']):
+            # Different hydrogens than the cached molecule; charge it again
+            return None
+        charges = np.zeros([len(order)])
+        charges[order] = saved['charges']
+        return charges
+
+    def put(self, mol, method):
+        """
+        Stores the partial charges currently assigned to mol.
+        """
+        key, canonical = ChargeKey(mol, method)
+        order = CanonicalOrder(mol)
+        atoms = list(mol.GetAtoms())
+        buf = io.BytesIO()
+        np.savez(buf, charges=np.array([atoms[i].GetPartialCharge() for i in order]),
+                 atomic_numbers=np.array([atoms[i].GetAtomicNum() for i in order]))
+        self.conn.execute('INSERT OR REPLACE INTO charges VALUES (?,?,?,?)',
+                          (key, canonical, method, sqlite3.Binary(buf.getvalue())))
+
+def Default():
+    """
+    Returns this process' cache at $IMPRESS_CHARGE_CACHE, or None if it is unset or 'off'.
+    """
+    path = os.environ.get('IMPRESS_CHARGE_CACHE', '')
+    if path.lower() in ('', 'off', 'none'):
+        return None
+    if path not in _caches:
+        _caches[path] = ChargeCache(path)
+    return _caches[path]
+
+def AssignCharges(mol, method='am1bcc', cache=None):
+    """
+    Sets the partial charges of mol, from the cache when the molecule has been charged before.
+    Raises RuntimeError if charging fails.
+    """
+    cache = cache or Default()
+    if cache is not None:
+        charges = cache.get(mol, method)
+        if charges is not None:
+            for atom, q in zip(mol.GetAtoms(), charges):
+                atom.SetPartialCharge(float(q))
+            return
+    with timing.Span('charging', method=method):
+        if not oequacpac.OEAssignCharges(mol, METHODS[method]()):
+            raise(RuntimeError("OEAssignCharges failed."))
+    if cache is not None:
+        cache.put(mol, method)
+
+@timing.Stage('charge', 'path')
+def ChargeLigand(path, method='am1bcc'):
+    """
+    Reads path/lig.pdb (from RunDocking), charges it and writes path/charged.mol2 for antechamber.
+    """
+    mol = oechem.OEMol()
+    ifs = oechem.oemolistream()
+    if ifs.open(f'{path}/lig.pdb'):
+        oechem.OEReadMolecule(ifs,mol)
+        ifs.close()
+    AssignCharges(mol, method)
+    ofs = oechem.oemolostream()
+    if ofs.open(f'{path}/charged.mol2'):
+        oechem.OEWriteMolecule(ofs,mol)
+        ofs.close()
+    return path
+
+def ChargeLigands(paths, workers=2, depth=None, method='am1bcc'):
+    """
+    Runs ChargeLigand for every directory in paths in a pool of worker processes, with at most
+      depth (default 2*workers) ligands in flight. Yields (path, error or None) in input order.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    depth = depth or 2 * workers
+    def collect(pending):
+        path, future = pending.popleft()
+        try:
+            future.result()
+            return path, None
+        except Exception as e:
+            return path, e
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path in paths:
+            pending.append((path, pool.submit(ChargeLigand, path, method)))
+            if len(pending) >= depth:
+                yield collect(pending)
+        while pending:
+            yield collect(pending)
@@ -0,0 +1,58 @@
+"""
+Checkpoints for long simulations, so a preempted job continues where it stopped.
+A checkpoint is an .npz with the partially filled energy arrays, the loop counters and any number
+  of serialized OpenMM States (positions, velocities, box and context parameters).
+Files are written to a temporary name and renamed, so a checkpoint is either complete or absent.
+"""
+import os
+import numpy as np
+import simtk.openmm as mm
+
+def Save(filename, states=None, **arrays):
+    """
+    Atomically writes arrays and {name: State} to filename.
+    """
+    for name, state in (states or {}).items():
+        arrays[f'state_{name}'] = np.array(mm.XmlSerializer.serialize(state))
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, filename)
+
+def Load(filename, **expected):
+    """
+    Returns the checkpoint as a dict, with the States under 'states', or None if there is none
+      or if any of the expected values (e.g. niter=1000) differs from what was saved.
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        with np.load(filename) as f:
+            data = {key: f[key] for key in f.files}
+    except (OSError, ValueError):
+        return None
+    for key, value in expected.items():
+        if key not in data or data[key] != value:
+            return None
+    data['states'] = {key[len('state_'):]: mm.XmlSerializer.deserialize(str(data.pop(key)))
+                      for key in list(data) if key.startswith('state_')}
+    return data
+
+def Due(iteration, interval, niter):
+    """
+    True if a checkpoint should be written after iteration (counting from 1).
+    """
+    return interval > 0 and (iteration % interval == 0 or iteration == niter)
+
+def NextStop(iteration, interval, niter):
+    """
+    The iteration of the next checkpoint after iteration, so the steps in between can be run in one call.
+    """
+    if interval <= 0:
+        return niter
+    return min(niter, (iteration // interval + 1) * interval)
+
+def Remove(*filenames):
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
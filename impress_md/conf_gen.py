@@ -1,5 +1,21 @@
 import sys
+from collections import deque
 from openeye import oechem, oeomega
+from . import timing
+
+# One Omega engine per process, built on first use by GetOmega.
+_omega = None
+
+def GetOmega():
+    """
+    Returns this process' OEOmega engine. Building the engine is not free, so it is reused
+      for every molecule instead of being recreated in FromMol.
+    """
+    global _omega
+    if _omega is None:
+        omegaOpts = oeomega.OEOmegaOptions()
+        _omega = oeomega.OEOmega(omegaOpts)
+    return _omega
 
 def FromMol(mol, isomer=True, num_enantiomers=1):
     """
@@ -9,8 +25,7 @@ def FromMol(mol, isomer=True, num_enantiomers=1):
         isomers is a boolean controling whether or not the various diasteriomers of a molecule are created
         num_enantiomers is the allowable number of enantiomers. For all, set to -1
     """
-    omegaOpts = oeomega.OEOmegaOptions()
-    omega = oeomega.OEOmega(omegaOpts)
+    omega = GetOmega()
     out_conf = []
     
     if not isomer:
@@ -34,17 +49,77 @@ def FromMol(mol, isomer=True, num_enantiomers=1):
 
     return out_conf
 
-def FromString(smiles, isomer=True, num_enantiomers=1):
+def FromString(smiles, isomer=True, num_enantiomers=1, store=None):
     """
     Generates an set of conformers from a SMILES string
+    If store is the path of a conformer store (see conf_store.py), ensembles are looked up there
+      first and newly generated ones are added to it.
     """
+    if store is not None:
+        from . import conf_store
+        cached = conf_store.OpenStore(store).get(smiles, isomer, num_enantiomers)
+        if cached is not None:
+            return cached
     mol = oechem.OEMol()
     if not oechem.OESmilesToMol(mol,smiles):
         print("SMILES invalid for string", smiles)
         return None
     else:
-        return FromMol(mol,isomer,num_enantiomers)
+        with timing.Span('omega'):
+            confs = FromMol(mol,isomer,num_enantiomers)
+        if store is not None:
+            conf_store.OpenStore(store).put(smiles, confs, isomer, num_enantiomers)
+        return confs
 
 # TODO: Placeholder
 def SelectEnantiomer(mol_list):
     return mol_list[0]
+
+def MolToBytes(mol):
+    """
+    Serializes a (multi-conformer) molecule to OEB so it can be passed between processes.
+    """
+    ofs = oechem.oemolostream()
+    ofs.SetFormat(oechem.OEFormat_OEB)
+    ofs.openstring()
+    oechem.OEWriteMolecule(ofs, mol)
+    return ofs.GetString()
+
+def MolFromBytes(data):
+    ifs = oechem.oemolistream()
+    ifs.SetFormat(oechem.OEFormat_OEB)
+    ifs.openstring(data)
+    mol = oechem.OEMol()
+    oechem.OEReadMolecule(ifs, mol)
+    return mol
+
+def _SelectedFromString(smiles, isomer, num_enantiomers, store):
+    # Runs in a pool worker. OpenEye molecules do not pickle, so the result goes back as OEB.
+    confs = FromString(smiles, isomer, num_enantiomers, store)
+    if not confs:
+        return None
+    return MolToBytes(SelectEnantiomer(confs))
+
+def PrefetchConformers(ligands, workers=2, depth=8, isomer=True, num_enantiomers=1, store=None):
+    """
+    Generates conformers in a pool of worker processes ahead of the consumer.
+    ligands is an iterable of tuples whose last element is a SMILES string. For each one,
+      the tuple extended with the selected enantiomer (or None on failure) is yielded, in input order.
+    Up to depth molecules are queued in the pool, so conformers for the next ligands are built
+      while the caller docks the current one. Each worker keeps its own Omega engine.
+    store is passed on to FromString.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    def collect(pending):
+        ligand, future = pending.popleft()
+        data = future.result()
+        return tuple(ligand) + (MolFromBytes(data) if data is not None else None,)
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for ligand in ligands:
+            pending.append((ligand, pool.submit(_SelectedFromString, ligand[-1], isomer, num_enantiomers, store)))
+            if len(pending) >= depth:
+                yield collect(pending)
+        while pending:
+            yield collect(pending)
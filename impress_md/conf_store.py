@@ -0,0 +1,188 @@
+"""
+Persistent store of Omega conformer ensembles.
+Ensembles are kept as OEB files, keyed by the canonical isomeric SMILES and the Omega/Flipper
+  settings, so rescreening a library against another receptor skips conformer generation for
+  every molecule seen before.
+The key is the index: the ensemble with key k is <store>/k[:2]/k.oeb, so a lookup is a single
+  open(). Files are written under a temporary name and renamed into place, so ranks on any number
+  of nodes sharing a parallel filesystem read and add ensembles without locks and never see half
+  an ensemble.
+Its size is bounded by $IMPRESS_CONF_STORE_MAX (in MB, unbounded if unset); the least recently
+  used ensembles, by file modification time, are evicted beyond that.
+"""
+import os
+import time
+import hashlib
+from multiprocessing import util
+from openeye import oechem
+
+# Open stores, one per path and process (see OpenStore).
+_stores = {}
+
+# Hits whose access time is written back at once
+TOUCH_BATCH = 64
+# Puts by one process between two scans of the store for eviction
+EVICT_EVERY = 256
+# Age (s) after which a temporary file is taken to be left behind by a crashed process
+STALE_TMP = 3600
+
+def CanonicalSmiles(smiles):
+    """
+    Returns the canonical isomeric SMILES of a SMILES string, or None if it does not parse.
+    """
+    mol = oechem.OEGraphMol()
+    if not oechem.OESmilesToMol(mol, smiles):
+        return None
+    return oechem.OECreateIsoSmiString(mol)
+
+def StoreKey(canonical_smiles, isomer, num_enantiomers):
+    text = f'{canonical_smiles} isomer={bool(isomer)} num_enantiomers={int(num_enantiomers)}'
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def EnsembleToBytes(mols):
+    ofs = oechem.oemolostream()
+    ofs.SetFormat(oechem.OEFormat_OEB)
+    ofs.openstring()
+    for mol in mols:
+        oechem.OEWriteMolecule(ofs, mol)
+    return ofs.GetString()
+
+def EnsembleFromBytes(data):
+    ifs = oechem.oemolistream()
+    ifs.SetFormat(oechem.OEFormat_OEB)
+    ifs.openstring(data)
+    return [oechem.OEMol(mol) for mol in ifs.GetOEMols()]
+
+class ConformerStore():
+    """
+    Key -> OEB ensemble store with least recently used eviction.
+    max_bytes bounds the total size of the stored ensembles (None = unbounded). A process only
+      scans the store for eviction every EVICT_EVERY puts, so it can overshoot by that much.
+    Hits refresh the modification time of their file in batches of TOUCH_BATCH, best effort,
+      and at exit.
+    """
+    def __init__(self, path, max_bytes=None):
+        if os.path.isfile(path):
+            raise RuntimeError(f"{path} is a conformer store in the old single SQLite file format; "
+                               "pass a directory instead")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touched = set()
+        self.puts = 0
+        os.makedirs(path, exist_ok=True)
+        # Also run when a pool worker exits, where atexit handlers do not
+        util.Finalize(self, self.touch, exitpriority=10)
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], f'{key}.oeb')
+
+    def get(self, smiles, isomer=True, num_enantiomers=1):
+        """
+        Returns the stored list of conformer OEMols, or None on a miss.
+        """
+        canonical = CanonicalSmiles(smiles)
+        if canonical is None:
+            return None
+        filename = self.filename(StoreKey(canonical, isomer, num_enantiomers))
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self.touched.add(filename)
+        if len(self.touched) >= TOUCH_BATCH:
+            self.touch()
+        return EnsembleFromBytes(data)
+
+    def touch(self):
+        """
+        Marks the ensembles of recent hits as used. Only guides eviction, so errors are ignored.
+        """
+        touched, self.touched = self.touched, set()
+        for filename in touched:
+            try:
+                os.utime(filename)
+            except OSError:
+                pass
+
+    def put(self, smiles, mols, isomer=True, num_enantiomers=1):
+        canonical = CanonicalSmiles(smiles)
+        if canonical is None or not mols:
+            return
+        filename = self.filename(StoreKey(canonical, isomer, num_enantiomers))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = f'{filename}.{os.uname().nodename}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(EnsembleToBytes(mols))
+        os.replace(tmp, filename)
+        self.puts += 1
+        if self.max_bytes is not None and self.puts % EVICT_EVERY == 1:
+            self.touch()
+            self.evict()
+
+    def entries(self):
+        """
+        Returns [(modification time, size, filename)] of the stored ensembles and removes
+          temporary files older than STALE_TMP.
+        """
+        entries = []
+        now = time.time()
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    stat = entry.stat()
+                    if entry.name.endswith('.oeb'):
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    elif entry.name.endswith('.tmp') and now - stat.st_mtime > STALE_TMP:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    # Evicted or renamed by another rank meanwhile
+                    pass
+        return entries
+
+    def size(self):
+        return sum(size for mtime, size, filename in self.entries())
+
+    def evict(self):
+        """
+        Drops the least recently used ensembles until the store is under 90% of max_bytes.
+        Several ranks may evict at once; files another rank removed first are skipped.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, filename in entries)
+        if total <= self.max_bytes:
+            return
+        target = 0.9 * self.max_bytes
+        for mtime, size, filename in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def close(self):
+        self.touch()
+
+def MaxBytes():
+    """
+    Returns the size limit from $IMPRESS_CONF_STORE_MAX (MB) in bytes, or None if it is unset.
+    """
+    mb = os.environ.get('IMPRESS_CONF_STORE_MAX', '')
+    return int(float(mb) * 1024**2) if mb else None
+
+def OpenStore(path, max_bytes=None):
+    """
+    Returns this process' ConformerStore for path, opening it on first use.
+    max_bytes defaults to MaxBytes().
+    """
+    if max_bytes is None:
+        max_bytes = MaxBytes()
+    if path not in _stores:
+        _stores[path] = ConformerStore(path, max_bytes)
+    elif max_bytes is not None:
+        _stores[path].max_bytes = max_bytes
+    return _stores[path]
@@ -1,4 +1,10 @@
+import os
 from openeye import oechem, oedocking
+from . import timing
+
+# Receptors and initialized OEDock objects, keyed by (path, mtime, size).
+# Filled by LoadDock so each process reads the receptor once.
+_dock_cache = {}
 
 def PrepareReceptor(pdb,padding=4,outpath=""):
     """
@@ -87,15 +93,59 @@ def PrepareReceptorFromBinary(filename):
     oedocking.OEReadReceptorFile(receptor,filename)
     return receptor
 
-def DockConf(pdb_file, mol, MAX_POSES = 5):
-    receptor = oechem.OEGraphMol()
-    oedocking.OEReadReceptorFile(receptor, pdb_file)
-    dock = oedocking.OEDock()
-    dock.Initialize(receptor)
+def _ReceptorKey(filename):
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+def InitializeDock(filename):
+    """
+    Reads a receptor oeb and returns an initialized OEDock object along with the receptor.
+    This is the expensive part of docking, so prefer LoadDock which caches the result.
+    """
+    with timing.Span('receptor_load'):
+        receptor = oechem.OEGraphMol()
+        if not oedocking.OEReadReceptorFile(receptor, filename):
+            raise RuntimeError(f"Could not read receptor file {filename}")
+        dock = oedocking.OEDock()
+        dock.Initialize(receptor)
+    return dock, receptor
+
+def LoadDock(filename):
+    """
+    Returns (dock, receptor) for a receptor oeb, loading and initializing it once per process.
+    The cache is keyed on the path, modification time and size, so a rewritten receptor
+      file is picked up on the next call and the stale entry is dropped.
+    """
+    key = _ReceptorKey(filename)
+    if key not in _dock_cache:
+        for stale in [k for k in _dock_cache if k[0] == key[0]]:
+            del _dock_cache[stale]
+        _dock_cache[key] = InitializeDock(filename)
+    return _dock_cache[key]
+
+def ClearDockCache():
+    _dock_cache.clear()
+
+def DockConfWithDock(dock, receptor, mol, MAX_POSES = 5):
+    """
+    Same as DockConf, but takes an already initialized OEDock object (see LoadDock).
+    """
     lig = oechem.OEMol()
-    err = dock.DockMultiConformerMolecule(lig,mol,MAX_POSES)
+    with timing.Span('oedock'):
+        err = dock.DockMultiConformerMolecule(lig,mol,MAX_POSES)
     return dock, lig, receptor
 
+def DockConf(pdb_file, mol, MAX_POSES = 5, use_cache=True):
+    """
+    Docks the conformers in mol into the receptor stored in pdb_file (an oeb).
+    With use_cache the receptor is only read and initialized on the first call in a process.
+    """
+    if use_cache:
+        dock, receptor = LoadDock(pdb_file)
+    else:
+        dock, receptor = InitializeDock(pdb_file)
+    return DockConfWithDock(dock, receptor, mol, MAX_POSES)
+
 def WriteStructures(receptor, lig, apo_path, lig_path):
     ofs = oechem.oemolostream()
     success = True
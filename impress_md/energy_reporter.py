@@ -0,0 +1,144 @@
+"""
+Potential energy recorder that runs inside simulation.step(), so a production run is a single
+  step(n) call instead of a Python loop of step() and getState(), and nothing is parsed back from a log.
+Energies (kJ/mol) go to a preallocated array, or to a memory-mapped .npy file, and the running mean,
+  variance and autocorrelation are kept up to date as samples arrive.
+"""
+import numpy as np
+from simtk import unit
+
+
+class EnergyReporter(object):
+    """EnergyReporter records the potential energy of a Simulation every reportInterval steps.
+
+    To use it, create an EnergyReporter, then add it to the Simulation's list of reporters.
+    """
+
+    def __init__(self, reportInterval, capacity, file=None, max_lag=100):
+        """Create an EnergyReporter.
+
+        Parameters
+        ----------
+        reportInterval : int
+            The interval (in time steps) at which to record the energy
+        capacity : int
+            The maximum number of samples
+        file : string
+            If given, samples are written to this .npy file through a memory map instead of kept in memory
+        max_lag : int
+            The longest lag (in samples) of the autocorrelation function
+        """
+        self._reportInterval = reportInterval
+        if file is None:
+            self.values = np.zeros([capacity])
+        else:
+            self.values = np.lib.format.open_memmap(file, mode='w+', dtype=np.float64, shape=(capacity,))
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self._max_lag = max_lag
+        self._recent = np.zeros([max_lag]) # recent[j] is the sample j+1 before the newest
+        self._lag_sums = np.zeros([max_lag + 1])
+        self._lag_counts = np.zeros([max_lag + 1], np.int64)
+        self._shift = None
+
+    def describeNextReport(self, simulation):
+        """Get information about the next report this object will generate.
+
+        Parameters
+        ----------
+        simulation : Simulation
+            The Simulation to generate a report for
+
+        Returns
+        -------
+        tuple
+            A five element tuple. The first element is the number of steps
+            until the next report. The remaining elements specify whether
+            that report will require positions, velocities, forces, and
+            energies respectively.
+        """
+        steps = self._reportInterval - simulation.currentStep%self._reportInterval
+        return (steps, False, False, False, True)
+
+    def report(self, simulation, state):
+        """Generate a report.
+
+        Parameters
+        ----------
+        simulation : Simulation
+            The Simulation to generate a report for
+        state : State
+            The current state of the simulation
+        """
+        self.add(state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole))
+
+    def add(self, value):
+        """
+        Appends one sample and updates the running statistics (Welford for mean and variance).
+        """
+        if self.count == len(self.values):
+            raise IndexError("EnergyReporter is full ({} samples)".format(self.count))
+        self.values[self.count] = value
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        # Lag products are taken around the first sample; energies are large and their fluctuations small
+        if self._shift is None:
+            self._shift = value
+        x = value - self._shift
+        lags = min(self.count - 1, self._max_lag)
+        self._lag_sums[0] += x * x
+        self._lag_counts[0] += 1
+        self._lag_sums[1:lags+1] += x * self._recent[:lags]
+        self._lag_counts[1:lags+1] += 1
+        self._recent[1:] = self._recent[:-1]
+        self._recent[0] = x
+
+    def extend(self, values):
+        """
+        Appends samples recorded elsewhere, e.g. the part of a run restored from a checkpoint.
+        """
+        for value in values:
+            self.add(float(value))
+
+    @property
+    def energies(self):
+        """
+        The samples recorded so far.
+        """
+        return np.asarray(self.values[:self.count])
+
+    @property
+    def variance(self):
+        return self._m2 / self.count if self.count > 0 else np.nan
+
+    def autocorrelation(self):
+        """
+        Normalized autocorrelation function for lags 0..max_lag (NaN where there are no pairs yet).
+        Products are accumulated online, so the mean is removed only here: C(k) = <x_t x_t+k> - <x>^2.
+        """
+        if self._shift is None:
+            return np.full([self._max_lag + 1], np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            covariance = self._lag_sums / self._lag_counts - (self.mean - self._shift)**2
+            return covariance / self.variance
+
+    def statistical_inefficiency(self):
+        """
+        g = 1 + 2 sum_k (1 - k/N) C(k), summed until C(k) drops to zero, as in pymbar.timeseries.
+        Samples are roughly independent every g samples.
+        """
+        if self.count < 2 or not self.variance > 0:
+            return 1.0
+        g = 1.0
+        for k, c in enumerate(self.autocorrelation()[1:], 1):
+            if k >= self.count or not c > 0:
+                break
+            g += 2.0 * c * (1.0 - k / self.count)
+        return max(g, 1.0)
+
+    def flush(self):
+        if isinstance(self.values, np.memmap):
+            self.values.flush()
@@ -1,6 +1,7 @@
 import sys, os
 import numpy as np
 from contextlib import contextmanager
+from . import results, timing
 
 @contextmanager
 def working_directory(directory):
@@ -11,12 +12,13 @@ def working_directory(directory):
     finally:
         os.chdir(owd)
 
-def RunDocking(smiles, inpath, outpath, padding=4):
+@timing.Stage('dock', 'outpath')
+def RunDocking(smiles, inpath, outpath, padding=4, conf_store=None):
     from . import conf_gen
     from . import dock_conf
     if not os.path.exists(outpath):
         os.mkdir(outpath)
-    confs = conf_gen.SelectEnantiomer(conf_gen.FromString(smiles))
+    confs = conf_gen.SelectEnantiomer(conf_gen.FromString(smiles, store=conf_store))
     # This receptor can be pre-compiled to an oeb. It speeds things up
     filename, file_extension = os.path.splitext(inpath)
     #if file_extension == ".oeb":
@@ -31,9 +33,7 @@ def RunDocking(smiles, inpath, outpath, padding=4):
     #   something about the range of poses.
 
     dock_conf.WriteStructures(receptor, lig, f'{outpath}/apo.pdb', f'{outpath}/lig.pdb')
-    with open(f'{outpath}/metrics.csv','w+') as metrics:
-        metrics.write("Dock,Dock_U\n")
-        metrics.write("{},{}\n".format(dock_conf.BestDockScore(dock,lig),0))
+    results.Record(outpath, {'Dock': dock_conf.BestDockScore(dock,lig), 'Dock_U': 0}, new=True, info={'smiles': smiles})
     # # If you uncomment the three lines below, it will save an image of the 2D
     #   molecule. This is useful as a sanity check.
     # from openeye import oedepict
@@ -41,12 +41,13 @@ def RunDocking(smiles, inpath, outpath, padding=4):
     # oedepict.OERenderMolecule(f'{outpath}/lig.png',lig)
 
 
-def RunDocking_(smiles, inpath, outpath, padding=4):
+@timing.Stage('dock', 'outpath')
+def RunDocking_(smiles, inpath, outpath, padding=4, conf_store=None):
     from . import conf_gen
     from . import dock_conf
     if not os.path.exists(outpath):
         os.mkdir(outpath)
-    confs = conf_gen.SelectEnantiomer(conf_gen.FromString(smiles))
+    confs = conf_gen.SelectEnantiomer(conf_gen.FromString(smiles, store=conf_store))
     # This receptor can be pre-compiled to an oeb. It speeds things up
     filename, file_extension = os.path.splitext(inpath)
     #if file_extension == ".oeb":
@@ -60,9 +61,7 @@ def RunDocking_(smiles, inpath, outpath, padding=4):
     #   the best pose, as scored by Openeye. It may be useful to consider
     #   something about the range of poses.
 
-    with open(f'{outpath}/metrics.csv','w+') as metrics:
-        metrics.write("Dock,Dock_U\n")
-        metrics.write("{},{}\n".format(dock_conf.BestDockScore(dock,lig),0))
+    results.Record(outpath, {'Dock': dock_conf.BestDockScore(dock,lig), 'Dock_U': 0}, new=True, info={'smiles': smiles})
     dock_conf.WriteStructures(receptor, lig, f'{outpath}/apo.pdb', f'{outpath}/lig.pdb')
     # # If you uncomment the three lines below, it will save an image of the 2D
     #   molecule. This is useful as a sanity check.
@@ -71,28 +70,43 @@ def RunDocking_(smiles, inpath, outpath, padding=4):
     # oedepict.OERenderMolecule(f'{outpath}/lig.png',lig)
     return dock_conf.BestDockScore(dock,lig)
 
-def ParameterizeOE(path):
+def RunDockingBatch(smiles_file, inpath, outpath, batch_size=1000, conf_workers=0, conf_depth=8, conf_store=None):
+    """
+    Docks every SMILES in smiles_file into the receptor oeb at inpath.
+    Unlike RunDocking this does not create a directory per ligand: all poses are written to
+      outpath/poses.oeb.gz and all scores to outpath/scores.csv, batch_size ligands at a time.
+    With conf_workers > 0, conformers are generated in that many processes, conf_depth ligands ahead.
+    conf_store is the path of a conformer store shared between screens (see conf_store.py).
+    """
+    from . import batch_dock
+    return batch_dock.RunBatchDocking(batch_dock.ReadSmiles(smiles_file), inpath, outpath, batch_size,
+                                      conf_workers=conf_workers, conf_depth=conf_depth, conf_store=conf_store)
+
+@timing.Stage('param', 'path')
+def ParameterizeOE(path, receptor_once=None, charged=False):
     """
     Reads in the PDB from 'RunDocking' and outputs 'charged.mol2' of the ligand
     Then runs antechamber to convert this to coordinate (.inpcrd) and 
     parameter (.prmtop) files.
+    With $IMPRESS_CHARGE_CACHE set, AM1-BCC charges come from the cache when the molecule was charged before (see charge.py);
+      charged means charged.mol2 has already been written, e.g. by ParameterizeMany.
+    With receptor_once the receptor is parameterized only for the first ligand and the complex is
+      assembled with ParmEd (see receptor_param.py). Defaults to on when $IMPRESS_RECEPTOR_PARAMS is set.
     """
-    from openeye import oechem, oeomega, oequacpac
-    mol = oechem.OEMol()
-    ifs = oechem.oemolistream()
-    if ifs.open(f'{path}/lig.pdb'):
-        oechem.OEReadMolecule(ifs,mol)
-        ifs.close()
-    if not oequacpac.OEAssignCharges(mol,oequacpac.OEAM1BCCCharges()):
-        raise(RuntimeError("OEAssignCharges failed."))
-    ofs = oechem.oemolostream()
-    if ofs.open(f'{path}/charged.mol2'):
-        oechem.OEWriteMolecule(ofs,mol)
+    if receptor_once is None:
+        receptor_once = 'IMPRESS_RECEPTOR_PARAMS' in os.environ
+    if not charged:
+        from . import charge
+        charge.ChargeLigand(path)
     
-    import subprocess
     with working_directory(path):
-        subprocess.check_output(f'antechamber -i lig.pdb -fi pdb -o lig.mol2 -fo mol2 -pf y -an y -a charged.mol2 -fa mol2 -ao crg',shell=True)
-        subprocess.check_output(f'parmchk2 -i lig.mol2 -f mol2 -o lig.frcmod',shell=True)
+        timing.CheckOutput(f'antechamber -i lig.pdb -fi pdb -o lig.mol2 -fo mol2 -pf y -an y -a charged.mol2 -fa mol2 -ao crg')
+        timing.CheckOutput(f'parmchk2 -i lig.mol2 -f mol2 -o lig.frcmod')
+    if receptor_once:
+        from . import receptor_param
+        receptor_param.BuildSystem(path)
+        return
+    with working_directory(path):
         # Wrap tleap
         with open(f'leap.in','w+') as leap:
             leap.write("source leaprc.protein.ff14SBonlysc\n")
@@ -106,20 +120,47 @@ def ParameterizeOE(path):
             leap.write("saveAmberParm lig lig.prmtop lig.inpcrd\n")
             leap.write("saveAmberParm com com.prmtop com.inpcrd\n")
             leap.write("quit\n")
-        subprocess.check_output(f'tleap -f leap.in',shell=True)
+        timing.CheckOutput(f'tleap -f leap.in')
+
+
+def ParameterizeMany(paths, workers=2, receptor_once=None):
+    """
+    ParameterizeOE for many ligand directories. Charging runs ahead in a pool of worker processes
+      while the antechamber and tleap steps of already charged ligands run here.
+    Returns {path: error} for the ligands that failed.
+    """
+    from . import charge
+    failed = dict()
+    for path, error in charge.ChargeLigands(paths, workers):
+        try:
+            if error is not None:
+                raise error
+            ParameterizeOE(path, receptor_once, charged=True)
+        except Exception as e:
+            print("Parameterization failed for", path, e)
+            failed[path] = e
+    return failed
 
 
-def ParameterizeAMBER(path):
+@timing.Stage('param', 'path')
+def ParameterizeAMBER(path, receptor_once=None):
     """
     Alternative method for parameterizing the system. It uses sqm and runs much slower than
     ParameterizeOE, which works through OpenEye.
     This function is pretty much a wrapper for antechamber & tleap. 
     I've kept it as a backup in case there are issues with OpenEye. 
+    receptor_once works as in ParameterizeOE.
     """
-    import subprocess
+    if receptor_once is None:
+        receptor_once = 'IMPRESS_RECEPTOR_PARAMS' in os.environ
+    with working_directory(path):
+        timing.CheckOutput(f'antechamber -i lig.pdb -fi pdb -o lig.mol2 -fo mol2 -c bcc -pf y -an y')
+        timing.CheckOutput(f'parmchk2 -i lig.mol2 -f mol2 -o lig.frcmod')
+    if receptor_once:
+        from . import receptor_param
+        receptor_param.BuildSystem(path)
+        return
     with working_directory(path):
-        subprocess.check_output(f'antechamber -i lig.pdb -fi pdb -o lig.mol2 -fo mol2 -c bcc -pf y -an y',shell=True)
-        subprocess.check_output(f'parmchk2 -i lig.mol2 -f mol2 -o lig.frcmod',shell=True)
         with open(f'leap.in','w+') as leap:
             leap.write("source leaprc.protein.ff14SBonlysc\n")
             leap.write("source leaprc.gaff\n")
@@ -132,150 +173,177 @@ def ParameterizeAMBER(path):
             leap.write("saveAmberParm lig lig.prmtop lig.inpcrd\n")
             leap.write("saveAmberParm com com.prmtop com.inpcrd\n")
             leap.write("quit\n")
-        subprocess.check_output(f'tleap -f leap.in',shell=True)
+        timing.CheckOutput(f'tleap -f leap.in')
     
 
+@timing.Stage('minimize', 'outpath')
 def RunMinimization(build_path, outpath, one_traj=False):
     """
     We are minimizing all three structures, then checking the potential energy using GB forcefields
     We could, alternatively, minimize the docked structure and then extract trajectories (1 frame long),
     more like a 1-trajectory mmgbsa.
     output is path used in "RunDocking". It has a metric.csv file.
+    With $IMPRESS_RECEPTOR_CACHE set, the receptor energy comes from the cache after the first ligand (see receptor_cache.py).
+    With one_traj only the complex is minimized (see minimize.OneTrajEnergies).
     """
-    from . import minimize
+    from . import minimize, platforms, receptor_cache
     success = True
     try:
-        rec_energy = minimize.MinimizedEnergy(f'{build_path}/apo')
-        lig_energy = minimize.MinimizedEnergy(f'{build_path}/lig')
-        com_energy = minimize.MinimizedEnergy(f'{build_path}/com')
+        if one_traj:
+            com_energy, rec_energy, lig_energy = minimize.OneTrajEnergies(build_path)
+        else:
+            rec_energy = receptor_cache.MinimizedEnergy(f'{build_path}/apo')
+            lig_energy = minimize.MinimizedEnergy(f'{build_path}/lig')
+            com_energy = minimize.MinimizedEnergy(f'{build_path}/com')
         diff_energy = com_energy - lig_energy - rec_energy
     except:
         success = False
-    
-    if one_traj:
-        print("1-traj calculation not ready")
-    # TODO: We could decide to do 1-trajectory mmgbsa. It would run about twice as fast as the
-    #       current method. I think it would be less accurate, but maybe not. Look into the 1-traj
-    #       method from Coveney papers if you want to implement this.
 
-    with open(f'{outpath}/metrics.csv','r') as metrics:
-        dat = metrics.readlines()
-    with open(f'{outpath}/metrics.csv','w') as metrics:
-        metrics.write(dat[0].replace('\n',',Minimize,Minimize_U\n'))
-        if success:
-            metrics.write(dat[1].replace('\n',',{},{}\n'.format(diff_energy,0)))
-        else:
-            metrics.write(dat[1].replace('\n',',NA,NA\n'))
+
+    if success:
+        results.Record(outpath, {'Minimize': diff_energy, 'Minimize_U': 0, 'Minimize_platform': platforms.last_used})
+    else:
+        results.Record(outpath, {'Minimize': 'NA', 'Minimize_U': 'NA', 'Minimize_platform': platforms.last_used or 'NA'})
+@timing.Stage('minimize', 'outpath')
 def RunMinimization_(build_path, outpath, one_traj=False):
-    from . import minimize
+    from . import minimize, platforms, receptor_cache
     success = True
     try:
-        rec_energy = minimize.MinimizedEnergy(f'{build_path}/apo')
-        lig_energy = minimize.MinimizedEnergy(f'{build_path}/lig')
-        com_energy = minimize.MinimizedEnergy(f'{build_path}/com')
+        if one_traj:
+            com_energy, rec_energy, lig_energy = minimize.OneTrajEnergies(build_path)
+        else:
+            rec_energy = receptor_cache.MinimizedEnergy(f'{build_path}/apo')
+            lig_energy = minimize.MinimizedEnergy(f'{build_path}/lig')
+            com_energy = minimize.MinimizedEnergy(f'{build_path}/com')
         diff_energy = com_energy - lig_energy - rec_energy
     except:
         success = False
-
-    if one_traj:
-        print("1-traj calculation not ready")
-    # TODO: We could decide to do 1-trajectory mmgbsa. It would run about twice as fast as the
-    #       current method. I think it would be less accurate, but maybe not. Look into the 1-traj
-    #       method from Coveney papers if you want to implement this.
-    with open(f'{outpath}/metrics.csv','r') as metrics:
-        dat = metrics.readlines()
-    with open(f'{outpath}/metrics.csv','w') as metrics:
-        metrics.write(dat[0].replace('\n',',Minimize,Minimize_U\n'))
-        if success:
-            metrics.write(dat[1].replace('\n',',{},{}\n'.format(diff_energy,0)))
-        else:
-            metrics.write(dat[1].replace('\n',',NA,NA\n'))
+    if success:
+        results.Record(outpath, {'Minimize': diff_energy, 'Minimize_U': 0, 'Minimize_platform': platforms.last_used})
+    else:
+        results.Record(outpath, {'Minimize': 'NA', 'Minimize_U': 'NA', 'Minimize_platform': platforms.last_used or 'NA'})
     if success:
         return diff_energy
     else:
         return np.nan
 
 
-def Simulation_explicit(inpath, outpath, nsteps, comp='com'):
+@timing.Stage('explicit', 'inpath')
+def Simulation_explicit(inpath, outpath, nsteps, comp='com', full_trajectory=False):
     if not os.path.exists(outpath):
         os.mkdir(outpath)
 
-    from . import minimize
+    from . import minimize, platforms
     success = True
     try:
-        potential = minimize.simulation(f'{inpath}/{comp}', outpath, nsteps)
+        potential = minimize.simulation(f'{inpath}/{comp}', outpath, nsteps, full_trajectory)
     except:
         success = False
 
-    with open(f'{inpath}/metrics.csv','r') as metrics:
-        dat = metrics.readlines()
-    with open(f'{inpath}/metrics.csv','w') as metrics:
-        metrics.write(dat[0].replace('\n',',U_mean_explicit\n'))
-        if success:
-            metrics.write(dat[1].replace('\n',',{}\n'.format(potential)))
-        else:
-            metrics.write(dat[1].replace('\n',',NA\n'))
+    if success:
+        results.Record(inpath, {'U_mean_explicit': potential, 'explicit_platform': platforms.last_used})
+    else:
+        results.Record(inpath, {'U_mean_explicit': 'NA', 'explicit_platform': platforms.last_used or 'NA'})
     if success:
         return potential
     else:
         return np.nan
 
-def RunMMGBSA(inpath, outpath, niter=1000):
+@timing.Stage('mmgbsa', 'outpath')
+def RunMMGBSA(inpath, outpath, niter=1000, one_traj=False, checkpoint_interval=100, concurrent=False):
     """
     1 'iteration' corresponds to 1 ps.
+    Every checkpoint_interval iterations the run is checkpointed in inpath and resumed from there
+      after a restart (0 turns checkpoints off).
+    With $IMPRESS_RECEPTOR_CACHE set, the apo trajectory comes from the cache after the first ligand (see receptor_cache.py).
+    With one_traj only the complex is simulated (see mmgbsa.simulate_one_traj).
+    With concurrent the lig, apo and com phases run at the same time in separate processes.
     """
-    from . import mmgbsa
+    from . import mmgbsa, platforms, receptor_cache
     crds = {'lig':f'{inpath}/lig.inpcrd','apo':f'{inpath}/apo.inpcrd','com':f'{inpath}/com.inpcrd'}
     prms = {'lig':f'{inpath}/lig.prmtop','apo':f'{inpath}/apo.prmtop','com':f'{inpath}/com.prmtop'}
     
-    enthalpies = mmgbsa.simulate(crds, prms, niter)
-    # enthalpies is a list of energies from each iteration
-    mmgbsa.subsample(enthalpies)
-    # We subsample the enthalpies using a method from John Chodera that determines the equilibration
-    #   and autocorrelation times. This allows us to extract an uncertainty.
-    #   See the file mmgbsa.py or his package 'pymbar' for more detail.
-    energies = mmgbsa.mmgbsa(enthalpies)
+    if one_traj:
+        enthalpies = mmgbsa.simulate_one_traj(crds, prms, niter, checkpoint_interval)
+        mmgbsa.subsample_one_traj(enthalpies)
+        energies = mmgbsa.mmgbsa_one_traj(enthalpies)
+    else:
+        enthalpies = mmgbsa.simulate(crds, prms, niter, receptor_cache=receptor_cache.Default(),
+                                     checkpoint_interval=checkpoint_interval, concurrent=concurrent)
+        # enthalpies is a list of energies from each iteration
+        mmgbsa.subsample(enthalpies)
+        # We subsample the enthalpies using a method from John Chodera that determines the equilibration
+        #   and autocorrelation times. This allows us to extract an uncertainty.
+        #   See the file mmgbsa.py or his package 'pymbar' for more detail.
+        energies = mmgbsa.mmgbsa(enthalpies)
     
-    with open(f'{outpath}/metrics.csv','r') as metrics:
-        dat = metrics.readlines()
-    with open(f'{outpath}/metrics.csv','w') as metrics:
-        metrics.write(dat[0].replace('\n',',mmgbsa,mmgbsa_U\n'))
-        metrics.write(dat[1].replace('\n',',{},{}\n'.format(energies[0]['diff'],energies[1]['diff'])))
+    results.Record(outpath, {'mmgbsa': energies[0]['diff'], 'mmgbsa_U': energies[1]['diff'],
+                             'mmgbsa_platform': platforms.last_used})
     return energies
 
 
-def RunMMGBSA_(inpath, outpath, niter=1000):
+@timing.Stage('mmgbsa', 'outpath')
+def RunMMGBSA_(inpath, outpath, niter=1000, one_traj=False, checkpoint_interval=100, concurrent=False):
     """
     1 'iteration' corresponds to 1 ps.
     """
-    from . import mmgbsa
+    from . import mmgbsa, platforms, receptor_cache
     crds = {'lig':f'{inpath}/lig.inpcrd','apo':f'{inpath}/apo.inpcrd','com':f'{inpath}/com.inpcrd'}
     prms = {'lig':f'{inpath}/lig.prmtop','apo':f'{inpath}/apo.prmtop','com':f'{inpath}/com.prmtop'}
 
-    enthalpies = mmgbsa.simulate(crds, prms, niter)
-    # enthalpies is a list of energies from each iteration
-    mmgbsa.subsample(enthalpies)
-    # We subsample the enthalpies using a method from John Chodera that determines the equilibration
-    #   and autocorrelation times. This allows us to extract an uncertainty.
-    #   See the file mmgbsa.py or his package 'pymbar' for more detail.
-    energies = mmgbsa.mmgbsa(enthalpies)
+    if one_traj:
+        enthalpies = mmgbsa.simulate_one_traj(crds, prms, niter, checkpoint_interval)
+        mmgbsa.subsample_one_traj(enthalpies)
+        energies = mmgbsa.mmgbsa_one_traj(enthalpies)
+    else:
+        enthalpies = mmgbsa.simulate(crds, prms, niter, receptor_cache=receptor_cache.Default(),
+                                     checkpoint_interval=checkpoint_interval, concurrent=concurrent)
+        # enthalpies is a list of energies from each iteration
+        mmgbsa.subsample(enthalpies)
+        # We subsample the enthalpies using a method from John Chodera that determines the equilibration
+        #   and autocorrelation times. This allows us to extract an uncertainty.
+        #   See the file mmgbsa.py or his package 'pymbar' for more detail.
+        energies = mmgbsa.mmgbsa(enthalpies)
 
-    with open(f'{outpath}/metrics.csv','r') as metrics:
-        dat = metrics.readlines()
-    with open(f'{outpath}/metrics.csv','w') as metrics:
-        metrics.write(dat[0].replace('\n',',mmgbsa,mmgbsa_U\n'))
-        metrics.write(dat[1].replace('\n',',{},{}\n'.format(energies[0]['diff'],energies[1]['diff'])))
+    results.Record(outpath, {'mmgbsa': energies[0]['diff'], 'mmgbsa_U': energies[1]['diff'],
+                             'mmgbsa_platform': platforms.last_used})
     return energies[0]['diff']
 
-def RunAlchemy(path, niter=2500, nsteps_per_iter=1000, nlambda=11):
+@timing.Stage('alchemy', 'path')
+def RunAlchemy(path, niter=2500, nsteps_per_iter=1000, nlambda=11, nworkers=1, assignment='cyclic', mpi=False,
+               cutoff=None, pocket=None, exchange=False, checkpoint_interval=100):
     """
     Default is a 5 ns simulation with sampling every 2 ps
+    The lambda windows run in nworkers processes, or over all MPI ranks with mpi=True
+      (then only rank 0 writes the metrics and returns the energy; the others return None).
+    cutoff and pocket (in nm) restrict the alchemical interactions, see alchemy.AddAlchemyForces.
+    exchange runs Hamiltonian replica exchange between the windows instead of independent windows,
+      in this process or over the MPI ranks with mpi=True (nworkers and assignment are then unused).
+    Every checkpoint_interval iterations the windows (or replicas) are checkpointed in path and
+      resumed from there after a restart (0 turns checkpoints off).
     """
-    from . import alchemy
-    [energy, err] = alchemy.SimulateAlchemy(path, niter, nsteps_per_iter, nlambda)
-    with open(f'{path}/metrics.csv','r') as metrics:
-        dat = metrics.readlines()
-    with open(f'{path}/metrics.csv','w') as metrics:
-        metrics.write(dat[0].replace('\n',',alchemy,alchemy_U\n'))
-        metrics.write(dat[1].replace('\n',',{},{}\n'.format(energy,err)))
+    from . import alchemy, platforms
+    from simtk import unit
+    cutoff = cutoff*unit.nanometers if cutoff is not None else None
+    pocket = pocket*unit.nanometers if pocket is not None else None
+    if exchange:
+        comm = None
+        if mpi:
+            from mpi4py import MPI
+            comm = MPI.COMM_WORLD
+        result = alchemy.SimulateReplicaExchange(path, niter, nsteps_per_iter, nlambda, comm, cutoff, pocket,
+                                                 checkpoint_interval=checkpoint_interval)
+        if result is None:
+            return None
+        [energy, err] = result
+    elif mpi:
+        result = alchemy.SimulateAlchemyMPI(path, niter, nsteps_per_iter, nlambda, assignment=assignment,
+                                            cutoff=cutoff, pocket=pocket, checkpoint_interval=checkpoint_interval)
+        if result is None:
+            return None
+        [energy, err] = result
+    else:
+        [energy, err] = alchemy.SimulateAlchemy(path, niter, nsteps_per_iter, nlambda, nworkers, assignment,
+                                                cutoff, pocket, checkpoint_interval)
+    results.Record(path, {'alchemy': energy, 'alchemy_U': err, 'alchemy_platform': platforms.last_used})
     return energy, err
@@ -0,0 +1,145 @@
+"""
+Library preprocessing: canonicalize SMILES, collapse duplicates and fan results back out.
+Vendor libraries repeat molecules under different spellings, as salts and as other tautomers
+  or protonation states. Only the first occurrence of each canonical form is dispatched, as the
+  vendor's structure with salts stripped; the canonical protomer only serves as the key.
+The (library, row) -> unique molecule mapping is kept in SQLite so libraries larger than memory
+  stream through, and several libraries can share one set of unique molecules.
+"""
+import csv
+import sqlite3
+import hashlib
+from openeye import oechem
+
+def Canonicalize(smiles, strip_salts=True, tautomer=True):
+    """
+    Returns (key SMILES, parent SMILES), or (None, None) if smiles does not parse.
+    The parent is the canonical isomeric SMILES of the molecule as given, with only the largest
+      component if strip_salts. The key is the same unless tautomer, where it is OpenEye's canonical
+      protomer of the parent, so tautomers and protonation variants collapse together.
+    """
+    mol = oechem.OEGraphMol()
+    if not oechem.OESmilesToMol(mol, smiles):
+        return None, None
+    if strip_salts:
+        oechem.OEDeleteEverythingExceptTheFirstLargestComponent(mol)
+    parent = oechem.OECreateIsoSmiString(mol)
+    if tautomer:
+        from openeye import oequacpac
+        protomer = oechem.OEGraphMol()
+        if oequacpac.OEGetUniqueProtomer(protomer, mol):
+            return oechem.OECreateIsoSmiString(protomer), parent
+    return parent, parent
+
+def MoleculeKey(canonical_smiles):
+    return hashlib.sha1(canonical_smiles.encode()).hexdigest()
+
+def OpenMapping(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS molecules (key TEXT PRIMARY KEY, uid INTEGER, smiles TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS rows (library TEXT, row INTEGER, name TEXT, smiles TEXT, uid INTEGER, '
+                 'PRIMARY KEY (library, row))')
+    if 'library' not in [column[1] for column in conn.execute('PRAGMA table_info(rows)')]:
+        conn.close()
+        raise RuntimeError(f"{db_path} maps rows without a library; deduplicate into a new file")
+    conn.execute('CREATE INDEX IF NOT EXISTS rows_uid ON rows (uid)')
+    return conn
+
+def Libraries(db_path):
+    conn = OpenMapping(db_path)
+    libraries = [row[0] for row in conn.execute('SELECT DISTINCT library FROM rows ORDER BY library')]
+    conn.close()
+    return libraries
+
+def Deduplicate(ligands, db_path, library='', commit_every=10000, strip_salts=True, tautomer=True):
+    """
+    Streams (row, name, smiles) tuples (see batch_dock.ReadSmiles) and yields (uid, name, smiles)
+      for the first occurrence of every canonical molecule. uid counts unique molecules from 0.
+    Every input row is recorded in db_path under library with the uid it maps to (NULL if the
+      SMILES is invalid), replacing an earlier mapping of the same library.
+    If db_path already holds molecules, only the ones not seen before are yielded, numbered on
+      from the last uid.
+    """
+    conn = OpenMapping(db_path)
+    conn.execute('DELETE FROM rows WHERE library=?', (library,))
+    uid = conn.execute('SELECT COALESCE(MAX(uid)+1, 0) FROM molecules').fetchone()[0]
+    pending = 0
+    for row, name, smiles in ligands:
+        canonical, parent = Canonicalize(smiles, strip_salts, tautomer)
+        if canonical is None:
+            conn.execute('INSERT INTO rows VALUES (?,?,?,?,NULL)', (library, row, name, smiles))
+        else:
+            key = MoleculeKey(canonical)
+            found = conn.execute('SELECT uid FROM molecules WHERE key=?', (key,)).fetchone()
+            if found is None:
+                conn.execute('INSERT INTO molecules VALUES (?,?,?)', (key, uid, parent))
+                yield uid, name, parent
+                found = (uid,)
+                uid += 1
+            conn.execute('INSERT INTO rows VALUES (?,?,?,?,?)', (library, row, name, smiles, found[0]))
+        pending += 1
+        if pending >= commit_every:
+            conn.commit()
+            pending = 0
+    conn.commit()
+    conn.close()
+
+def WriteUnique(ligands, db_path, out_file, library='', **kwargs):
+    """
+    Writes the unique molecules of ligands to a .smi file runner.py and docking.py -f can read.
+    Data line i of out_file is the molecule with uid i. Returns the number of unique molecules.
+    The file is written from db_path after the scan, so on a rerun against an existing db_path it
+      also holds the molecules stored before, and the uids stay line numbers.
+    """
+    for _ in Deduplicate(ligands, db_path, library, **kwargs):
+        pass
+    conn = OpenMapping(db_path)
+    # Named after their first row in this library, else in any library, else by uid
+    query = ('SELECT uid, smiles, (SELECT name FROM rows WHERE rows.uid = molecules.uid '
+             'ORDER BY library != ?, library, row LIMIT 1) FROM molecules ORDER BY uid')
+    count = 0
+    with open(out_file, 'w') as out:
+        out.write("smiles name\n")
+        for uid, smiles, name in conn.execute(query, (library,)):
+            if uid != count:
+                conn.close()
+                raise RuntimeError(f"{db_path} has no molecule with uid {count}")
+            out.write(f"{smiles} {name if name is not None else uid}\n")
+            count += 1
+    conn.close()
+    return count
+
+def FanOut(results_file, db_path, out_file, key='row', library=None):
+    """
+    Expands a results table over unique molecules (one line per uid, in column key) back to
+      one line per original row of library. Rows whose molecule has no result get empty fields.
+    library may be left out when db_path maps a single library.
+    """
+    if library is None:
+        libraries = Libraries(db_path)
+        if len(libraries) != 1:
+            raise ValueError(f"{db_path} maps the libraries {libraries}; choose one")
+        library = libraries[0]
+    conn = OpenMapping(db_path)
+    with open(results_file, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        key_col = header.index(key)
+        columns = [c for c in header if c != key]
+        conn.execute('DROP TABLE IF EXISTS results')
+        conn.execute('CREATE TABLE results (uid INTEGER PRIMARY KEY, {})'.format(
+            ','.join(f'"{c}"' for c in columns)))
+        insert = 'INSERT OR REPLACE INTO results VALUES ({})'.format(','.join('?' * (len(columns) + 1)))
+        conn.executemany(insert, ([r[key_col]] + [v for i, v in enumerate(r) if i != key_col] for r in reader))
+    conn.commit()
+
+    with open(out_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['row', 'name', 'smiles', 'uid'] + columns)
+        query = ('SELECT rows.row, rows.name, rows.smiles, rows.uid, {} FROM rows '
+                 'LEFT JOIN results ON rows.uid = results.uid WHERE rows.library = ? ORDER BY rows.row').format(
+                     ','.join(f'results."{c}"' for c in columns))
+        for r in conn.execute(query, (library,)):
+            writer.writerow(['' if v is None else v for v in r])
+    conn.close()
@@ -1,34 +1,71 @@
 from simtk.openmm import app
 import simtk.openmm as mm
 from simtk import unit
-import solventlessPdbReporter as nosol
+import numpy as np
+import os
+from . import platforms, timing
 
-def MinimizedEnergy(filepath):
+@timing.Timed('system_creation')
+def CreateSystem(prmtop):
+    return prmtop.createSystem(implicitSolvent=app.GBn2,
+                               nonbondedMethod=app.CutoffNonPeriodic,
+                               nonbondedCutoff=1.0*unit.nanometers,
+                               constraints=app.HBonds,
+                               rigidWater=True,
+                               ewaldErrorTolerance=0.0005)
+
+def MinimizedSimulation(filepath):
     prmtop = app.AmberPrmtopFile(f'{filepath}.prmtop')
     inpcrd = app.AmberInpcrdFile(f'{filepath}.inpcrd')
-    system = prmtop.createSystem(implicitSolvent=app.GBn2,
-                                 nonbondedMethod=app.CutoffNonPeriodic,
-                                 nonbondedCutoff=1.0*unit.nanometers,
-                                 constraints=app.HBonds,
-                                 rigidWater=True,
-                                 ewaldErrorTolerance=0.0005)
+    system = CreateSystem(prmtop)
 
     integrator = mm.LangevinIntegrator(300*unit.kelvin,
                                        1.0/unit.picoseconds,
                                        2.0*unit.femtoseconds)
     integrator.setConstraintTolerance(0.00001)
-    # TODO: This should just recognize whatever the computer is capable of, not force CUDA.
-    platform = mm.Platform.getPlatformByName('CUDA')
     # TODO: I am not sure if mixed precision is necessary. It dramatically changes the results.
-    properties = {'CudaPrecision': 'mixed'}
+    platform, properties = platforms.GetPlatform()
     
-    simulation = app.Simulation(prmtop.topology, system, integrator, platform)
+    simulation = app.Simulation(prmtop.topology, system, integrator, platform, properties)
     simulation.context.setPositions(inpcrd.positions)
     
-    simulation.minimizeEnergy()
-    energy = simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoule/unit.mole)
+    with timing.Span('minimization'):
+        simulation.minimizeEnergy()
+    return simulation
+
+def MinimizedEnergy(filepath):
+    simulation = MinimizedSimulation(filepath)
+    with timing.Span('energy_readback'):
+        energy = simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoule/unit.mole)
     return energy
 
+def SinglePointEnergy(filepath, positions):
+    """
+    Potential energy of the system in filepath.prmtop at the given positions, without minimizing.
+    """
+    prmtop = app.AmberPrmtopFile(f'{filepath}.prmtop')
+    system = CreateSystem(prmtop)
+    integrator = mm.VerletIntegrator(1.0*unit.femtoseconds)
+    platform, properties = platforms.GetPlatform()
+    context = mm.Context(system, integrator, platform, properties)
+    context.setPositions(positions)
+    return context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoule/unit.mole)
+
+def OneTrajEnergies(build_path):
+    """
+    1-trajectory version of minimizing apo, lig and com separately: only the complex is minimized,
+      and the receptor and ligand energies are evaluated on its coordinates (receptor atoms first).
+    Returns (com_energy, rec_energy, lig_energy).
+    """
+    simulation = MinimizedSimulation(f'{build_path}/com')
+    state = simulation.context.getState(getEnergy=True, getPositions=True)
+    positions = state.getPositions(asNumpy=True)
+    n_apo = app.AmberPrmtopFile(f'{build_path}/apo.prmtop').topology.getNumAtoms()
+    com_energy = state.getPotentialEnergy().value_in_unit(unit.kilojoule/unit.mole)
+    rec_energy = SinglePointEnergy(f'{build_path}/apo', positions[:n_apo])
+    lig_energy = SinglePointEnergy(f'{build_path}/lig', positions[n_apo:])
+    return com_energy, rec_energy, lig_energy
+
 
 # def MinimizedEnergyWithParam(filepath):
 #     prmtop = app.AmberPrmtopFile(f'{filepath}.prmtop')
@@ -56,41 +93,57 @@ def MinimizedEnergy(filepath):
 #     energy = simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoule / unit.mole)
 #     return energy
 
-def simulation(filepath, outpath, nsteps):
-    prmtop = app.AmberPrmtopFile(f'{filepath}.prmtop')
-    inpcrd = app.AmberInpcrdFile(f'{filepath}.inpcrd')
-    forcefield = app.ForceField('amber14-all.xml', 'amber14/tip3p.xml')
-    modeller = app.Modeller(prmtop.topology, inpcrd.positions)
-    modeller.addSolvent(forcefield, padding=1.4*unit.nanometer)
-    system = forcefield.createSystem(modeller.topology, nonbondedMethod=app.PME, nonbondedCutoff=1.0*unit.nanometer,
-            constraints=app.HBonds)
+def simulation(filepath, outpath, nsteps, full_trajectory=False):
+    """
+    Solvates the system in filepath.prmtop/.inpcrd (apo and com in the cached receptor box),
+      minimizes it and runs nsteps of explicit solvent MD.
+    Returns the mean potential energy (kJ/mol) of the snapshots taken every 50 ps, which are also
+      kept in outpath/energies.npy.
+    The solute is written every 50 ps to outpath/solute.dcd (topology in solute.dcd.pdb); the whole
+      system, water included, only with full_trajectory (outpath/traj.dcd).
+    GPU precision follows $IMPRESS_PRECISION like everywhere else, but defaults to double here
+      when it is unset.
+    """
+    from .energy_reporter import EnergyReporter
+    from .solute_reporter import SoluteReporter
+    from . import solvent_box
+    # With $IMPRESS_SOLVENT_BOX set, the receptor box is solvated and equilibrated once and reused
+    # for every ligand (see solvent_box.py)
+    forcefield = solvent_box.GetForceField()
+    modeller = solvent_box.SolvatedSystem(filepath)
+    with timing.Span('system_creation'):
+        system = forcefield.createSystem(modeller.topology, nonbondedMethod=app.PME, nonbondedCutoff=1.0*unit.nanometer,
+                constraints=app.HBonds)
     integrator = mm.LangevinIntegrator(300*unit.kelvin, 1.0/unit.picosecond, 0.002*unit.picosecond)
-    platform = mm.Platform.getPlatformByName('CUDA')
-    properties = {'Precision': 'double'}
+    platform, properties = platforms.GetPlatform(precision=os.environ.get('IMPRESS_PRECISION', 'double'))
     simulation = app.Simulation(modeller.topology, system, integrator, platform, properties)
     simulation.context.setPositions(modeller.positions)
-    simulation.minimizeEnergy()
-    if nsteps != 0:
+    with timing.Span('minimization'):
+        simulation.minimizeEnergy()
+    if nsteps == 0:
+        return simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoule/unit.mole)
+
+    energies = EnergyReporter(25000, nsteps // 25000, file=f'{outpath}/energies.npy') # reporting at every 50 ps
+    simulation.reporters.append(energies)
+    if full_trajectory:
         simulation.reporters.append(app.DCDReporter(f'{outpath}/traj.dcd', 25000)) # snapshot at every 50 ps 
-        simulation.reporters.append(nosol.NewPDBReporter(f'{outpath}/system_nosol.pdb', 25000)) # snapshot at every 50 ps 
-        simulation.reporters.append(app.StateDataReporter(f'{outpath}/sim.log', 25000, step=True,
-        potentialEnergy=True, temperature=True)) # reporting at every 50 ps
-        simulation.reporters.append(app.CheckpointReporter(f'{outpath}/traj.chk', 250000)) # checkpoint at every 0.5 ns
+    simulation.reporters.append(SoluteReporter(f'{outpath}/solute.dcd', 25000, simulation.topology)) # snapshot at every 50 ps 
+    simulation.reporters.append(app.StateDataReporter(f'{outpath}/sim.log', 25000, step=True,
+    potentialEnergy=True, temperature=True)) # reporting at every 50 ps
+    simulation.reporters.append(app.CheckpointReporter(f'{outpath}/traj.chk', 250000)) # checkpoint at every 0.5 ns
+    with timing.Span('md_steps', steps=nsteps):
         simulation.step(nsteps)
-        positions = simulation.context.getState(getPositions=True).getPositions()
-        app.PDBFile.writeFile(simulation.topology, positions, open(f'{outpath}/output.pdb', 'w'))
+    positions = simulation.context.getState(getPositions=True).getPositions()
+    app.PDBFile.writeFile(simulation.topology, positions, open(f'{outpath}/output.pdb', 'w'))
+    energies.flush()
 
 # Return potential energy at the end of the simulation
 #    potential = simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoule/unit.mole)
 #    return potential
 
 # Return mean potential energy during the simulation
-    with open(f'{outpath}/sim.log','r') as log_file: 
-        lines = log_file.readlines()
-        mean = 0
-    for i in range(1,len(lines)):
-        potential = float(lines[i].split(',')[1])
-        mean = mean + potential
-    potential = mean/(len(lines)-1)
-    return potential
-	
+    if energies.count == 0:
+        return np.nan
+    print("Potential energy {:.1f} +- {:.1f} kJ/mol, statistical inefficiency {:.1f}".format(
+        energies.mean, np.sqrt(energies.variance), energies.statistical_inefficiency()))
+    return energies.mean
@@ -1,55 +1,278 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from pymbar import timeseries
 from math import sqrt
+from . import platforms, checkpoint, timing
 
+NSTEPS_PER_ITERATION = 500 # 1 picosecond
 
-def simulate(inpcrd_filenames, prmtop_filenames, niterations=1000, implicit=True):
+
+# Worker processes of simulate(concurrent=True), one per phase and kept for the life of this process,
+#   so the ligand phases of successive (or concurrent) ligands share one worker.
+_phase_pools = {}
+_phase_pools_lock = threading.Lock()
+
+# Relative cost of the phases when splitting CPU threads; the ligand alone is tiny.
+PHASE_WEIGHTS = {'com': 10, 'apo': 10, 'lig': 1}
+
+
+def simulate(inpcrd_filenames, prmtop_filenames, niterations=1000, implicit=True, receptor_cache=None,
+             checkpoint_interval=0, concurrent=False):
     """
     The program simulates three systems: the ligand alone, protein alone, and complex.
     Input is a dict of files to the input coordinates (.inpcrd) and parameters (.prmtop) 
       as well as the number of iterations. One iteration is one picosecond. 
     Output is a dict of a list of the ennthalpies calculated using mmgbsa for each system.
+    If a receptor_cache is given (see receptor_cache.py), the 'apo' phase is simulated once
+      per receptor and reused for every ligand.
+    With checkpoint_interval > 0 every phase checkpoints to mmgbsa_<phase>.chk.npz next to its
+      prmtop that often (in iterations); the files are removed once all phases are done.
+    With concurrent=True the phases run at the same time in separate processes (see simulate_concurrent).
+    """
+    if concurrent:
+        return simulate_concurrent(inpcrd_filenames, prmtop_filenames, niterations, receptor_cache,
+                                   checkpoint_interval)
+    enthalpies = dict()
+    checkpoint_files = []
+    for phase in inpcrd_filenames.keys():
+        if phase == 'apo' and receptor_cache is not None:
+            enthalpies[phase] = cached_phase(inpcrd_filenames[phase], prmtop_filenames[phase],
+                                             niterations, receptor_cache)
+        else:
+            checkpoint_file = None
+            if checkpoint_interval > 0:
+                checkpoint_file = checkpoint_path(prmtop_filenames[phase], phase)
+                checkpoint_files.append(checkpoint_file)
+            enthalpies[phase] = simulate_phase(inpcrd_filenames[phase], prmtop_filenames[phase], niterations,
+                                               checkpoint_file, checkpoint_interval)
+    checkpoint.Remove(*checkpoint_files)
+    return enthalpies
+
+
+def phase_pool(phase, environment):
+    """
+    Returns the single-process pool running phase with the IMPRESS_* platform settings in environment.
+    The settings themselves are applied by run_phase; ProcessPoolExecutor has no initializer on Python 3.6.
+    """
+    key = (phase, tuple(sorted(environment.items())))
+    with _phase_pools_lock:
+        if key not in _phase_pools:
+            _phase_pools[key] = ProcessPoolExecutor(max_workers=1)
+        return _phase_pools[key]
+
+
+def run_phase(environment, inpcrd_filename, prmtop_filename, niterations, cache_path=None, checkpoint_file=None,
+              checkpoint_interval=0):
+    """
+    One phase of simulate in a worker process, with the IMPRESS_* settings in environment.
+    Returns (enthalpies, platform label).
+    """
+    os.environ.update(environment)
+    if cache_path is not None:
+        from . import receptor_cache
+        enthalpies = cached_phase(inpcrd_filename, prmtop_filename, niterations, receptor_cache.Open(cache_path))
+    else:
+        enthalpies = simulate_phase(inpcrd_filename, prmtop_filename, niterations, checkpoint_file,
+                                    checkpoint_interval)
+    return enthalpies, platforms.last_used
+
+
+def simulate_concurrent(inpcrd_filenames, prmtop_filenames, niterations=1000, receptor_cache=None,
+                        checkpoint_interval=0):
+    """
+    simulate with every phase in its own worker process, so a ligand costs about as long as its
+      complex phase. The node is divided between the phases by platforms.Allocate: one GPU each
+      when $IMPRESS_DEVICE lists enough of them, otherwise CPU threads in proportion to PHASE_WEIGHTS.
+    platforms.last_used is set to the platform of the complex phase.
+    """
+    # Largest first, so the complex gets the first device and the leftover threads
+    phases = sorted(inpcrd_filenames.keys(), key=lambda phase: (-PHASE_WEIGHTS.get(phase, 1), phase != 'com'))
+    allocation = platforms.Allocate(phases, {phase: PHASE_WEIGHTS.get(phase, 1) for phase in phases})
+    futures = dict()
+    checkpoint_files = []
+    for phase in phases:
+        cache_path = receptor_cache.path if phase == 'apo' and receptor_cache is not None else None
+        checkpoint_file = None
+        if checkpoint_interval > 0 and cache_path is None:
+            checkpoint_file = checkpoint_path(prmtop_filenames[phase], phase)
+            checkpoint_files.append(checkpoint_file)
+        futures[phase] = phase_pool(phase, allocation[phase]).submit(
+            run_phase, allocation[phase], inpcrd_filenames[phase], prmtop_filenames[phase], niterations,
+            cache_path, checkpoint_file, checkpoint_interval)
+    enthalpies = dict()
+    labels = dict()
+    for phase in phases:
+        enthalpies[phase], labels[phase] = futures[phase].result()
+    platforms.last_used = labels.get('com', labels[phases[0]])
+    checkpoint.Remove(*checkpoint_files)
+    return enthalpies
+
+
+def checkpoint_path(prmtop_filename, name):
+    return os.path.join(os.path.dirname(prmtop_filename), f'mmgbsa_{name}.chk.npz')
+
+
+def cached_phase(inpcrd_filename, prmtop_filename, niterations, receptor_cache):
+    from .receptor_cache import SystemKey
+    platform, properties = platforms.GetPlatform()
+    key = SystemKey(prmtop_filename, inpcrd_filename, stage='mmgbsa', niterations=niterations,
+                    nsteps_per_iteration=NSTEPS_PER_ITERATION, platform=platforms.last_used)
+    return receptor_cache.get_or_compute(key, lambda: simulate_phase(inpcrd_filename, prmtop_filename, niterations))
+
+
+@timing.Timed('system_creation')
+def create_system(prmtop):
+    from simtk.openmm import app
+    from simtk import unit
+    return prmtop.createSystem(implicitSolvent=app.GBn2, 
+             nonbondedMethod=app.CutoffNonPeriodic,
+             nonbondedCutoff=2.0*unit.nanometers, 
+             constraints=app.HBonds)
+
+
+def setup_simulation(inpcrd_filename, prmtop_filename, equilibrate=True):
+    """
+    Returns a minimized and briefly equilibrated Simulation of one system.
+    With equilibrate=False the Simulation is left at the input coordinates, e.g. to load a checkpoint.
     """
     from simtk.openmm import app
     import simtk.openmm as mm
     from simtk import unit
-    
-    phases = inpcrd_filenames.keys()
-    nsteps_per_iteration = 500 # 1 picosecond
-    
-    enthalpies = dict()
-    for phase in phases:
-        enthalpies[phase] = np.zeros([niterations])
-        prmtop = app.AmberPrmtopFile(prmtop_filenames[phase])
-        inpcrd = app.AmberInpcrdFile(inpcrd_filenames[phase])
-        
-        system = prmtop.createSystem(implicitSolvent=app.GBn2, 
-                 nonbondedMethod=app.CutoffNonPeriodic,
-                 nonbondedCutoff=2.0*unit.nanometers, 
-                 constraints=app.HBonds)
-        integrator = mm.LangevinIntegrator(300*unit.kelvin, 1.0/unit.picoseconds, 2.0*unit.femtoseconds)
-        integrator.setConstraintTolerance(0.00001)
-        
-        platform = mm.Platform.getPlatformByName('CUDA')
-        # I'm not sure what the CudaDeviceIndex is about. Austin at 
-        properties = {'CudaPrecision': 'mixed', 'CudaDeviceIndex' : '0'}
-        simulation = app.Simulation(prmtop.topology, system, integrator, platform, properties)
-        simulation.context.setPositions(inpcrd.positions)
-        
-        # Minimize & equilibrate
+
+    prmtop = app.AmberPrmtopFile(prmtop_filename)
+    inpcrd = app.AmberInpcrdFile(inpcrd_filename)
+
+    system = create_system(prmtop)
+    integrator = mm.LangevinIntegrator(300*unit.kelvin, 1.0/unit.picoseconds, 2.0*unit.femtoseconds)
+    integrator.setConstraintTolerance(0.00001)
+
+    platform, properties = platforms.GetPlatform()
+    simulation = app.Simulation(prmtop.topology, system, integrator, platform, properties)
+    simulation.context.setPositions(inpcrd.positions)
+
+    if not equilibrate:
+        return simulation
+
+    # Minimize & equilibrate
+    with timing.Span('minimization'):
         simulation.minimizeEnergy()
-        simulation.context.setVelocitiesToTemperature(300*unit.kelvin)
-        simulation.step(100)
-        
-        # Run simulation
-        for iteration in range(niterations):
-            simulation.step(nsteps_per_iteration)
-            state = simulation.context.getState(getEnergy=True)
-            potential_energy = state.getPotentialEnergy()
-            enthalpies[phase][iteration] = potential_energy.value_in_unit(unit.kilojoules_per_mole)
-        del simulation
-        del system
-        del platform
+    simulation.context.setVelocitiesToTemperature(300*unit.kelvin)
+    simulation.step(100)
+    return simulation
+
+
+def load_checkpoint(checkpoint_file, niterations, inpcrd_filename, prmtop_filename, **arrays):
+    """
+    Returns (simulation, start iteration, arrays), resuming from checkpoint_file when it holds
+      a run with the same niterations. Otherwise a fresh setup_simulation with zeroed arrays.
+    """
+    saved = None
+    if checkpoint_file is not None:
+        saved = checkpoint.Load(checkpoint_file, niterations=niterations,
+                                nsteps_per_iteration=NSTEPS_PER_ITERATION)
+    if saved is None:
+        return setup_simulation(inpcrd_filename, prmtop_filename), 0, arrays
+    simulation = setup_simulation(inpcrd_filename, prmtop_filename, equilibrate=False)
+    simulation.context.setState(saved['states']['simulation'])
+    print('Resuming {} at iteration {}'.format(checkpoint_file, int(saved['iteration'])))
+    return simulation, int(saved['iteration']), {name: saved[name] for name in arrays}
+
+
+def save_checkpoint(checkpoint_file, simulation, iteration, niterations, **arrays):
+    state = simulation.context.getState(getPositions=True, getVelocities=True, getParameters=True)
+    checkpoint.Save(checkpoint_file, {'simulation': state}, iteration=iteration, niterations=niterations,
+                    nsteps_per_iteration=NSTEPS_PER_ITERATION, **arrays)
+
+
+def simulate_phase(inpcrd_filename, prmtop_filename, niterations=1000, checkpoint_file=None, checkpoint_interval=0):
+    """
+    Simulates a single system and returns the potential energy after every iteration.
+    The energies are recorded by an EnergyReporter, so the run is one step() call
+      (one per checkpoint if checkpoint_file is given).
+    If checkpoint_file is given, the run is saved there every checkpoint_interval iterations
+      and resumed from it when it already exists.
+    """
+    from .energy_reporter import EnergyReporter
+
+    simulation, start, arrays = load_checkpoint(checkpoint_file, niterations, inpcrd_filename, prmtop_filename,
+                                                enthalpies=np.zeros([niterations]))
+    reporter = EnergyReporter(NSTEPS_PER_ITERATION, niterations)
+    reporter.extend(arrays['enthalpies'][:start])
+    # Count production steps from 0 so a report falls at the end of every iteration
+    simulation.currentStep = start * NSTEPS_PER_ITERATION
+    simulation.reporters.append(reporter)
+
+    # Run simulation
+    iteration = start
+    while iteration < niterations:
+        stop = checkpoint.NextStop(iteration, checkpoint_interval if checkpoint_file else 0, niterations)
+        with timing.Span('md_steps', steps=(stop - iteration) * NSTEPS_PER_ITERATION):
+            simulation.step((stop - iteration) * NSTEPS_PER_ITERATION)
+        iteration = stop
+        if checkpoint_file is not None and iteration < niterations:
+            save_checkpoint(checkpoint_file, simulation, iteration, niterations, enthalpies=reporter.values)
+    del simulation
+    return reporter.energies
+
+
+def energy_context(prmtop_filename):
+    """
+    Returns (context, integrator) used only to evaluate energies of a system at given coordinates.
+    The integrator has to outlive the context, so both are returned.
+    """
+    from simtk.openmm import app
+    import simtk.openmm as mm
+    from simtk import unit
+    prmtop = app.AmberPrmtopFile(prmtop_filename)
+    system = create_system(prmtop)
+    integrator = mm.VerletIntegrator(1.0*unit.femtoseconds)
+    platform, properties = platforms.GetPlatform()
+    return mm.Context(system, integrator, platform, properties), integrator
+
+
+def simulate_one_traj(inpcrd_filenames, prmtop_filenames, niterations=1000, checkpoint_interval=0):
+    """
+    Single-trajectory MM-GBSA: only the complex is simulated. At every iteration the frame is split
+      into receptor and ligand coordinates (tleap writes 'combine {rec lig}' receptor first) and
+      their GB energies are evaluated in contexts built once from apo.prmtop and lig.prmtop.
+    Returns the same dict of enthalpies as simulate, with one entry per frame in every phase.
+    With checkpoint_interval > 0 the run checkpoints to mmgbsa_1traj.chk.npz next to the complex.
+    """
+    from simtk import unit
+    apo_context, apo_integrator = energy_context(prmtop_filenames['apo'])
+    lig_context, lig_integrator = energy_context(prmtop_filenames['lig'])
+    n_apo = apo_context.getSystem().getNumParticles()
+    n_lig = lig_context.getSystem().getNumParticles()
+
+    checkpoint_file = None
+    if checkpoint_interval > 0:
+        checkpoint_file = checkpoint_path(prmtop_filenames['com'], '1traj')
+    phases = ['lig', 'apo', 'com']
+    simulation, start, enthalpies = load_checkpoint(checkpoint_file, niterations, inpcrd_filenames['com'],
+                                                    prmtop_filenames['com'],
+                                                    **{phase: np.zeros([niterations]) for phase in phases})
+    if simulation.system.getNumParticles() != n_apo + n_lig:
+        raise ValueError("Complex has {} atoms, but receptor + ligand have {}".format(
+            simulation.system.getNumParticles(), n_apo + n_lig))
+
+    for iteration in range(start, niterations):
+        with timing.Span('md_steps', steps=NSTEPS_PER_ITERATION):
+            simulation.step(NSTEPS_PER_ITERATION)
+        with timing.Span('energy_readback'):
+            state = simulation.context.getState(getEnergy=True, getPositions=True)
+            positions = state.getPositions(asNumpy=True)
+            apo_context.setPositions(positions[:n_apo])
+            lig_context.setPositions(positions[n_apo:])
+            enthalpies['com'][iteration] = state.getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+            enthalpies['apo'][iteration] = apo_context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+            enthalpies['lig'][iteration] = lig_context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(unit.kilojoules_per_mole)
+        if checkpoint_file is not None and checkpoint.Due(iteration+1, checkpoint_interval, niterations):
+            save_checkpoint(checkpoint_file, simulation, iteration+1, niterations, **enthalpies)
+    del simulation, apo_context, lig_context
+    if checkpoint_file is not None:
+        checkpoint.Remove(checkpoint_file)
     return enthalpies
 
 
@@ -96,3 +319,31 @@ def mmgbsa(enthalpies):
     errDeltaH['diff'] = sqrt(errDeltaH['diff'])
     return DeltaH, errDeltaH
 
+
+def subsample_one_traj(enthalpies):
+    """
+    Same as subsample, but for simulate_one_traj: the phases come from the same frames, so
+      equilibration and correlation are detected on the per-frame binding energy and the
+      same frames are kept in every phase.
+    """
+    diff = enthalpies['com'] - enthalpies['apo'] - enthalpies['lig']
+    [t0, g, Neff_max] = timeseries.detectEquilibration(diff)
+    indices = timeseries.subsampleCorrelatedData(diff[t0:], g=g)
+    for phase in enthalpies:
+        enthalpies[phase] = enthalpies[phase][t0:][indices]
+
+
+def mmgbsa_one_traj(enthalpies):
+    """
+    Returns DeltaG, errDeltaG like mmgbsa, but the error of 'diff' comes from the per-frame
+      binding energies, which is lower than summing independent phase errors.
+    """
+    DeltaH = dict()
+    errDeltaH = dict()
+    for phase in enthalpies:
+        DeltaH[phase] = enthalpies[phase].mean()
+        errDeltaH[phase] = enthalpies[phase].std()**2/len(enthalpies[phase])
+    diff = enthalpies['com'] - enthalpies['apo'] - enthalpies['lig']
+    DeltaH['diff'] = diff.mean()
+    errDeltaH['diff'] = sqrt(diff.std()**2/len(diff))
+    return DeltaH, errDeltaH
@@ -0,0 +1,86 @@
+"""
+Picks the OpenMM platform and its properties for every simulation in the pipeline.
+By default the fastest platform available is used (CUDA, then OpenCL, CPU and Reference).
+It can be overridden without editing code through environment variables:
+    IMPRESS_PLATFORM   CUDA, OpenCL, CPU or Reference
+    IMPRESS_PRECISION  single, mixed or double (GPU platforms) [default: mixed]
+    IMPRESS_DEVICE     GPU device index, e.g. 0 or 0,1
+    IMPRESS_THREADS    Number of CPU platform threads [default: all cores]
+"""
+import os
+import simtk.openmm as mm
+
+SPEED_ORDER = ['CUDA', 'OpenCL', 'CPU', 'Reference']
+
+# The platform actually used by the last call to GetPlatform, for the metrics
+last_used = None
+
+def AvailablePlatforms():
+    names = [mm.Platform.getPlatform(i).getName() for i in range(mm.Platform.getNumPlatforms())]
+    return [name for name in SPEED_ORDER if name in names]
+
+def Properties(name, precision=None, device=None, threads=None):
+    """
+    Returns the OpenMM properties dict for platform name with the given presets.
+    Unset arguments fall back to the environment, then to the defaults above.
+    """
+    precision = precision or os.environ.get('IMPRESS_PRECISION', 'mixed')
+    device = device if device is not None else os.environ.get('IMPRESS_DEVICE')
+    threads = threads if threads is not None else os.environ.get('IMPRESS_THREADS', os.cpu_count())
+    if name == 'CUDA':
+        properties = {'CudaPrecision': precision}
+        if device is not None:
+            properties['CudaDeviceIndex'] = str(device)
+    elif name == 'OpenCL':
+        properties = {'OpenCLPrecision': precision}
+        if device is not None:
+            properties['OpenCLDeviceIndex'] = str(device)
+    elif name == 'CPU':
+        properties = {'Threads': str(threads)}
+    else:
+        properties = {}
+    return properties
+
+def GetPlatform(name=None, precision=None, device=None, threads=None):
+    """
+    Returns (platform, properties). Pass both to app.Simulation.
+    name defaults to $IMPRESS_PLATFORM, else the fastest available platform.
+    """
+    global last_used
+    name = name or os.environ.get('IMPRESS_PLATFORM') or AvailablePlatforms()[0]
+    platform = mm.Platform.getPlatformByName(name)
+    properties = Properties(name, precision, device, threads)
+    last_used = Describe(name, properties)
+    return platform, properties
+
+def Allocate(jobs, weights=None):
+    """
+    Splits this node between jobs that run at the same time in separate processes.
+    Returns {job: environment}, the IMPRESS_* variables each process should run with:
+      on GPU platforms the devices of $IMPRESS_DEVICE (default 0) are dealt out in order, so the
+      first jobs get a device of their own when there are enough; on the CPU the threads are split
+      in proportion to weights (default equal), at least one each.
+    """
+    name = os.environ.get('IMPRESS_PLATFORM') or AvailablePlatforms()[0]
+    weights = weights or {job: 1 for job in jobs}
+    if name in ('CUDA', 'OpenCL'):
+        devices = os.environ.get('IMPRESS_DEVICE', '0').split(',')
+        return {job: {'IMPRESS_PLATFORM': name, 'IMPRESS_DEVICE': devices[i % len(devices)]}
+                for i, job in enumerate(jobs)}
+    if name == 'CPU':
+        total = int(os.environ.get('IMPRESS_THREADS', os.cpu_count()))
+        scale = total / sum(weights[job] for job in jobs)
+        threads = {job: max(1, int(weights[job] * scale)) for job in jobs}
+        # Leftover threads from rounding down go to the first job
+        threads[jobs[0]] += max(0, total - sum(threads.values()))
+        return {job: {'IMPRESS_PLATFORM': name, 'IMPRESS_THREADS': str(threads[job])} for job in jobs}
+    return {job: {'IMPRESS_PLATFORM': name} for job in jobs}
+
+def Describe(name, properties):
+    """
+    Short label such as 'CUDA-mixed' or 'CPU-16' for reports.
+    """
+    for key in ['CudaPrecision', 'OpenCLPrecision', 'Threads']:
+        if key in properties:
+            return f'{name}-{properties[key]}'
+    return name
@@ -0,0 +1,116 @@
+"""
+Results for the receptor alone (apo), shared by every ligand of a campaign.
+The receptor is the same for every ligand, so its minimized energy and its MM-GBSA enthalpy
+  time series only need to be computed once. Entries are keyed by a hash of apo.prmtop and
+  apo.inpcrd plus the simulation settings, and kept in a SQLite file every rank can open.
+A per-key lock file makes sure only one rank computes a missing entry while the others wait for it.
+Caching is opt-in: set $IMPRESS_RECEPTOR_CACHE to the store, an absolute path on a filesystem
+  every rank of the campaign sees, so separate runs neither share nor scatter cache files by accident.
+  When it is set, RunMinimization, RunMMGBSA and their underscore variants use it without any
+  further change.
+The file uses SQLite's rollback journal, not WAL, whose index lives in shared memory that ranks on
+  different nodes do not share. Both the journal and the per-key lock files rely on POSIX file
+  locks, so a cache shared by several nodes must be on a filesystem where those work (e.g. Lustre
+  mounted with flock, GPFS); otherwise give each node its own cache.
+"""
+import os
+import io
+import fcntl
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+
+# Open caches, one per path and process (see Default).
+_caches = {}
+
+def SystemKey(prmtop, inpcrd, **settings):
+    """
+    Hashes the contents of a prmtop/inpcrd pair and the settings they are simulated with.
+    The %VERSION line of the prmtop is skipped; tleap stamps it with the date of every run.
+    """
+    h = hashlib.sha1()
+    with open(prmtop, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'%VERSION'):
+                h.update(line)
+    with open(inpcrd, 'rb') as f:
+        h.update(f.read())
+    h.update(repr(sorted(settings.items())).encode())
+    return h.hexdigest()
+
+class ReceptorCache():
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.lock_dir = f'{path}.locks'
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS receptor (key TEXT PRIMARY KEY, data BLOB)')
+
+    def get(self, key):
+        """
+        Returns the stored numpy array, or None on a miss.
+        """
+        row = self.conn.execute('SELECT data FROM receptor WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return None
+        return np.load(io.BytesIO(row[0]))
+
+    def put(self, key, value):
+        buf = io.BytesIO()
+        np.save(buf, np.asarray(value))
+        self.conn.execute('INSERT OR REPLACE INTO receptor VALUES (?,?)', (key, sqlite3.Binary(buf.getvalue())))
+
+    @contextmanager
+    def lock(self, key):
+        with open(f'{self.lock_dir}/{key}.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, computing and storing it with compute() on a miss.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock(key):
+            # Another rank may have filled it while we waited for the lock
+            value = self.get(key)
+            if value is None:
+                value = np.asarray(compute())
+                self.put(key, value)
+        return value
+
+def Default():
+    """
+    Returns this process' cache at $IMPRESS_RECEPTOR_CACHE, or None if it is unset or 'off'.
+    """
+    path = os.environ.get('IMPRESS_RECEPTOR_CACHE', '')
+    if path.lower() in ('', 'off', 'none'):
+        return None
+    return Open(path)
+
+def Open(path):
+    """
+    Returns this process' cache at path, opening it on first use.
+    """
+    if path not in _caches:
+        _caches[path] = ReceptorCache(path)
+    return _caches[path]
+
+def MinimizedEnergy(filepath, cache=None):
+    """
+    minimize.MinimizedEnergy through the cache. filepath is the prefix of the .prmtop/.inpcrd pair.
+    """
+    from . import minimize, platforms
+    cache = cache or Default()
+    if cache is None:
+        return minimize.MinimizedEnergy(filepath)
+    platform, properties = platforms.GetPlatform()
+    key = SystemKey(f'{filepath}.prmtop', f'{filepath}.inpcrd', stage='minimize', platform=platforms.last_used)
+    return float(cache.get_or_compute(key, lambda: minimize.MinimizedEnergy(filepath)))
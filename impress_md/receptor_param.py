@@ -0,0 +1,189 @@
+"""
+Parameterizes the receptor once per campaign instead of once per ligand.
+tleap is run on apo.pdb a single time (keyed by its contents) and the result is kept in a shared
+  directory. Per ligand only the small GAFF-only tleap for the ligand is run, and the complex is
+  assembled in-process with ParmEd as receptor + ligand, the same atom order as 'combine {rec lig}'.
+The directory is $IMPRESS_RECEPTOR_PARAMS (default receptor_params in the working directory).
+This path is experimental: the first complex built for every receptor is also built with a full
+  tleap run (COMPLEX_LEAP) and compared with CompareSystems. BuildSystem raises if they differ,
+  and only marks the receptor verified when they agree.
+"""
+import os
+import shutil
+import fcntl
+import hashlib
+from . import timing
+
+RECEPTOR_LEAP = ["source leaprc.protein.ff14SBonlysc",
+                 "set default PBRadii mbondi3",
+                 "rec = loadPDB apo.pdb",
+                 "saveAmberParm rec apo.prmtop apo.inpcrd",
+                 "quit"]
+
+LIGAND_LEAP = ["source leaprc.gaff",
+               "set default PBRadii mbondi3",
+               "lig = loadmol2 lig.mol2",
+               "loadAmberParams lig.frcmod",
+               "saveAmberParm lig lig.prmtop lig.inpcrd",
+               "quit"]
+
+COMPLEX_LEAP = ["source leaprc.protein.ff14SBonlysc",
+                "source leaprc.gaff",
+                "set default PBRadii mbondi3",
+                "rec = loadPDB apo.pdb",
+                "lig = loadmol2 lig.mol2",
+                "loadAmberParams lig.frcmod",
+                "com = combine {rec lig}",
+                "saveAmberParm com com.prmtop com.inpcrd",
+                "quit"]
+
+# Largest difference in energy per force (kJ/mol) and in per-atom parameters allowed by CompareSystems
+ENERGY_TOLERANCE = 1e-3
+PARAMETER_TOLERANCE = 1e-6
+
+def Directory():
+    return os.environ.get('IMPRESS_RECEPTOR_PARAMS', 'receptor_params')
+
+def ReceptorKey(apo_pdb):
+    """
+    Hashes the receptor structure together with the leap script it is parameterized with.
+    Only the atom records count; OEChem stamps the AUTHOR line of every PDB with the time.
+    """
+    h = hashlib.sha1()
+    with open(apo_pdb, 'rb') as f:
+        for line in f:
+            if line.startswith((b'ATOM', b'HETATM', b'TER')):
+                h.update(line)
+    h.update('\n'.join(RECEPTOR_LEAP).encode())
+    return h.hexdigest()
+
+def RunLeap(path, lines):
+    with open(f'{path}/leap.in','w+') as leap:
+        leap.write('\n'.join(lines) + '\n')
+    timing.CheckOutput('tleap -f leap.in', cwd=path)
+
+def ParameterizeReceptor(apo_pdb, directory=None):
+    """
+    Returns the paths of (apo.prmtop, apo.inpcrd) for the receptor in apo_pdb, running tleap
+      only if this receptor has not been parameterized before. One process builds it while
+      the others wait on a lock file.
+    """
+    directory = directory or Directory()
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, ReceptorKey(apo_pdb))
+    files = (f'{target}/apo.prmtop', f'{target}/apo.inpcrd')
+    if os.path.exists(target):
+        return files
+    with open(f'{target}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(target):
+                # Build next to the target and rename, so a crash never leaves half a receptor behind
+                tmp = f'{target}.{os.getpid()}.tmp'
+                shutil.rmtree(tmp, ignore_errors=True)
+                os.makedirs(tmp)
+                shutil.copyfile(apo_pdb, f'{tmp}/apo.pdb')
+                RunLeap(tmp, RECEPTOR_LEAP)
+                os.rename(tmp, target)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return files
+
+def Combine(path, apo_prmtop, apo_inpcrd):
+    """
+    Writes path/apo.* (copies of the cached receptor) and path/com.prmtop, com.inpcrd built
+      from them and path/lig.prmtop, lig.inpcrd.
+    """
+    import parmed
+    shutil.copyfile(apo_prmtop, f'{path}/apo.prmtop')
+    shutil.copyfile(apo_inpcrd, f'{path}/apo.inpcrd')
+    rec = parmed.load_file(f'{path}/apo.prmtop', xyz=f'{path}/apo.inpcrd')
+    lig = parmed.load_file(f'{path}/lig.prmtop', xyz=f'{path}/lig.inpcrd')
+    com = rec + lig
+    if not isinstance(com, parmed.amber.AmberParm):
+        com = parmed.amber.AmberParm.from_structure(com)
+    com.save(f'{path}/com.prmtop', overwrite=True)
+    com.save(f'{path}/com.inpcrd', format='rst7', overwrite=True)
+
+def BuildSystem(path):
+    """
+    Replaces the per-ligand tleap of ParameterizeOE/ParameterizeAMBER: path holds apo.pdb,
+      lig.mol2 and lig.frcmod, and gets apo, lig and com .prmtop/.inpcrd.
+    The first complex of every receptor is checked against tleap (see CheckCombine); raises
+      RuntimeError if they differ.
+    """
+    apo_prmtop, apo_inpcrd = ParameterizeReceptor(f'{path}/apo.pdb')
+    RunLeap(path, LIGAND_LEAP)
+    Combine(path, apo_prmtop, apo_inpcrd)
+    verified = os.path.join(os.path.dirname(apo_prmtop), 'combine_verified')
+    if not os.path.exists(verified):
+        differences = CheckCombine(path)
+        if differences:
+            raise RuntimeError("ParmEd complex differs from tleap in {}:\n{}".format(path, '\n'.join(differences)))
+        open(verified, 'w').close()
+
+def CheckCombine(path):
+    """
+    Builds the complex in path with one full tleap run, in a scratch directory, and compares it
+      with path/com.prmtop, com.inpcrd from Combine. Returns the differences (empty if none).
+    """
+    tmp = f'{path}/combine_check'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        for name in ['apo.pdb', 'lig.mol2', 'lig.frcmod']:
+            shutil.copyfile(f'{path}/{name}', f'{tmp}/{name}')
+        RunLeap(tmp, COMPLEX_LEAP)
+        return CompareSystems(f'{tmp}/com', f'{path}/com')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def ForceGroupEnergies(prmtop, inpcrd):
+    """
+    Returns {force name: energy in kJ/mol} of an AMBER system, without cutoffs or constraints and
+      with the GBn2 solvent MM-GBSA uses, on the Reference platform.
+    """
+    from simtk.openmm import app
+    import simtk.openmm as mm
+    from simtk import unit
+    system = prmtop.createSystem(implicitSolvent=app.GBn2, nonbondedMethod=app.NoCutoff, constraints=None)
+    forces = system.getForces()
+    for i, force in enumerate(forces):
+        force.setForceGroup(i)
+    context = mm.Context(system, mm.VerletIntegrator(0.001), mm.Platform.getPlatformByName('Reference'))
+    context.setPositions(inpcrd.positions)
+    return {f'{i}:{force.__class__.__name__}': context.getState(getEnergy=True, groups={i}).getPotentialEnergy()
+                .value_in_unit(unit.kilojoule_per_mole) for i, force in enumerate(forces)}
+
+def CompareSystems(reference, other):
+    """
+    Compares two AMBER systems, reference.prmtop/.inpcrd and other.prmtop/.inpcrd: the atoms,
+      charges, GB radii, the 1-4 scaling of every dihedral and the OpenMM energy of every force.
+    Returns a list of differences (empty if the systems are the same).
+    """
+    import numpy as np
+    import parmed
+    from simtk.openmm import app
+    differences = []
+    a = parmed.load_file(f'{reference}.prmtop', xyz=f'{reference}.inpcrd')
+    b = parmed.load_file(f'{other}.prmtop', xyz=f'{other}.inpcrd')
+    if [atom.name for atom in a.atoms] != [atom.name for atom in b.atoms]:
+        return ["atom names or order differ"]
+    for label, values in [('charges', lambda s: [atom.charge for atom in s.atoms]),
+                          ('GB radii', lambda s: [atom.solvent_radius for atom in s.atoms]),
+                          ('coordinates', lambda s: s.coordinates.ravel())]:
+        delta = np.abs(np.array(values(a), dtype=float) - np.array(values(b), dtype=float)).max()
+        if delta > PARAMETER_TOLERANCE:
+            differences.append(f"{label} differ by up to {delta}")
+    # Dihedral type tables can be ordered differently, so compare the scaling per dihedral
+    scaling = lambda s: sorted((d.atom1.idx, d.atom2.idx, d.atom3.idx, d.atom4.idx, d.improper,
+                                round(d.type.scee, 6), round(d.type.scnb, 6)) for d in s.dihedrals)
+    if scaling(a) != scaling(b):
+        differences.append("1-4 scaling factors (SCEE/SCNB) differ")
+    energies_a = ForceGroupEnergies(app.AmberPrmtopFile(f'{reference}.prmtop'), app.AmberInpcrdFile(f'{reference}.inpcrd'))
+    energies_b = ForceGroupEnergies(app.AmberPrmtopFile(f'{other}.prmtop'), app.AmberInpcrdFile(f'{other}.inpcrd'))
+    for force in sorted(set(energies_a) | set(energies_b)):
+        ea, eb = energies_a.get(force), energies_b.get(force)
+        if ea is None or eb is None or abs(ea - eb) > ENERGY_TOLERANCE:
+            differences.append(f"{force} energy {ea} vs {eb} kJ/mol")
+    return differences
@@ -0,0 +1,155 @@
+"""
+One results store for a whole campaign, so ranking ligands does not mean walking every ligand directory.
+Every stage appends (ligand, metric, value) records to a SQLite file; records are buffered and
+  committed in batches, so many ranks can write to it at once. It uses the rollback journal rather
+  than WAL, which does not work between nodes; ranks on several nodes need a filesystem with
+  working POSIX locks (e.g. Lustre mounted with flock, GPFS), or one store per node. Export turns the log into one row
+  per ligand with a column per metric (the latest value wins), Top ranks ligands by one metric.
+The store is $IMPRESS_RESULTS (off by default); per-ligand metrics.csv files are still written unless
+  $IMPRESS_METRICS_CSV is 'off'.
+"""
+import os
+import csv
+import time
+import sqlite3
+from multiprocessing import util
+
+# Open stores, one per path and process (see Default).
+_stores = {}
+
+def _value(value):
+    """
+    Numbers are stored as REAL, 'NA'/NaN/'' as NULL and anything else (platform labels, SMILES) as text.
+    """
+    if value is None or (isinstance(value, str) and value.strip().lower() in ('na', 'nan', '')):
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return None if value != value else value
+
+class ResultsStore():
+    def __init__(self, path, commit_every=100, commit_seconds=10, timeout=600):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+                          '(id INTEGER PRIMARY KEY, ligand TEXT, metric TEXT, value, time REAL, host TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_metric ON results (metric, value)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_ligand ON results (ligand)')
+        self.pending = []
+        self.last_commit = time.time()
+        self.pid = os.getpid()
+        self.host = f'{os.uname().nodename}:{self.pid}'
+        # Also flushed when a pool worker exits, where atexit handlers do not run
+        util.Finalize(self, self.flush, exitpriority=10)
+
+    def record(self, ligand, metrics):
+        """
+        Appends {metric: value} for ligand. Committed every commit_every records or commit_seconds.
+        """
+        now = time.time()
+        self.pending.extend((str(ligand), metric, _value(value), now, self.host) for metric, value in metrics.items())
+        if len(self.pending) >= self.commit_every or now - self.last_commit >= self.commit_seconds:
+            self.flush()
+
+    def flush(self):
+        if not self.pending or os.getpid() != self.pid:
+            return
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.executemany('INSERT INTO results (ligand, metric, value, time, host) VALUES (?,?,?,?,?)',
+                              self.pending)
+        self.conn.execute('COMMIT')
+        self.pending = []
+        self.last_commit = time.time()
+
+    def metrics(self):
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT metric FROM results ORDER BY metric')]
+
+    def top(self, metric, n=100, descending=False):
+        """
+        Returns [(ligand, value)] of the n best ligands by metric (lowest first unless descending).
+        Ligands whose latest value is missing or not a number are left out.
+        """
+        order = 'DESC' if descending else 'ASC'
+        return self.conn.execute("SELECT ligand, value FROM results WHERE metric=? AND typeof(value) IN ('real','integer') "
+                                 f'AND id IN (SELECT MAX(id) FROM results WHERE metric=? GROUP BY ligand) '
+                                 f'ORDER BY value {order} LIMIT ?', (metric, metric, n)).fetchall()
+
+    def export(self, out_file, metrics=None):
+        """
+        Writes a CSV with one row per ligand and a column per metric. Returns the number of ligands.
+        """
+        self.flush()
+        metrics = metrics or self.metrics()
+        count = 0
+        with open(out_file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ligand'] + metrics)
+            ligand, row = None, None
+            for name, metric, value in self.conn.execute('SELECT ligand, metric, value FROM results '
+                                                         'ORDER BY ligand, id'):
+                if name != ligand:
+                    if row is not None:
+                        writer.writerow([ligand] + [row.get(m, 'NA') for m in metrics])
+                        count += 1
+                    ligand, row = name, {}
+                row[metric] = 'NA' if value is None else value
+            if row is not None:
+                writer.writerow([ligand] + [row.get(m, 'NA') for m in metrics])
+                count += 1
+        return count
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+def Default():
+    """
+    Returns this process' store at $IMPRESS_RESULTS, or None if it is not set.
+    """
+    path = os.environ.get('IMPRESS_RESULTS', '')
+    if path.lower() in ('', 'off', 'none'):
+        return None
+    # A forked worker must not share its parent's connection
+    if path not in _stores or _stores[path].pid != os.getpid():
+        _stores[path] = ResultsStore(path)
+    return _stores[path]
+
+def WriteCSV():
+    """
+    False if $IMPRESS_METRICS_CSV turns the per-ligand metrics.csv files off.
+    """
+    return os.environ.get('IMPRESS_METRICS_CSV', 'on').lower() not in ('0', 'off', 'no', 'false')
+
+def LigandID(path):
+    """
+    Results of a ligand are keyed by the name of its directory, e.g. 'test12' for test12/.
+    """
+    return os.path.basename(os.path.normpath(path))
+
+def Record(path, metrics, ligand=None, new=False, info=None):
+    """
+    Records the metrics {name: value} of the ligand in directory path in the results store, and
+      as extra columns of path/metrics.csv (a new file if new).
+    info {name: value} goes to the store only, e.g. the SMILES.
+    """
+    store = Default()
+    if store is not None:
+        store.record(ligand or LigandID(path), dict(info or {}, **metrics))
+    if not WriteCSV():
+        return
+    header = ','.join(metrics.keys())
+    values = ','.join(str(value) for value in metrics.values())
+    if new:
+        with open(f'{path}/metrics.csv','w+') as f:
+            f.write(f'{header}\n{values}\n')
+        return
+    with open(f'{path}/metrics.csv','r') as f:
+        dat = f.readlines()
+    with open(f'{path}/metrics.csv','w') as f:
+        f.write(dat[0].replace('\n',f',{header}\n'))
+        f.write(dat[1].replace('\n',f',{values}\n'))
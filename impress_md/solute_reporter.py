@@ -0,0 +1,129 @@
+from simtk.openmm import app
+from simtk import unit
+import numpy as np
+
+# Residues left out of solute trajectories: water and the counterions the OpenMM modeller can add
+SOLVENT = {'WAT', 'HOH', 'TP4', 'TP5', 'T4E', 'NA', 'K', 'LI', 'CS', 'RB', 'CL', 'BR', 'F', 'IOD'}
+
+
+class SoluteReporter(object):
+    """SoluteReporter writes the solute (everything but water and counterions) of a Simulation
+    to a binary trajectory, as a light replacement for NewPDBReporter plus a full system DCDReporter.
+
+    The atom selection is computed once, as an index array, and the solute topology is written
+    once to <file>.pdb (with the first frame). Frames go to a DCD file if file ends in .dcd, or
+    else to a preallocated memory-mapped .npy of shape [capacity, atoms, 3] in nm, float32 or,
+    with quantize, int16 fixed point around one float32 origin per frame, the centre of the
+    solute's bounding box. Origins are kept in <file>.origin.npy, whose last row is the
+    resolution (quantize, 0, 0), so LoadFrames needs nothing else.
+
+    To use it, create a SoluteReporter, then add it to the Simulation's list of reporters.
+    """
+
+    def __init__(self, file, reportInterval, topology, capacity=None, quantize=None):
+        """Create a SoluteReporter.
+
+        Parameters
+        ----------
+        file : string
+            The file to write to, .dcd or .npy
+        reportInterval : int
+            The interval (in time steps) at which to write frames
+        topology : Topology
+            The topology of the simulated system
+        capacity : int
+            The maximum number of frames (.npy only)
+        quantize : float
+            Resolution in nm of int16 fixed point coordinates (.npy only), e.g. 0.001.
+            The solute has to fit in 2*32767*quantize nm (65 nm at 0.001); report raises
+            ValueError on a frame that does not.
+        """
+        self._reportInterval = reportInterval
+        self._file = file
+        self._selection = np.array([atom.index for atom in topology.atoms() if atom.residue.name not in SOLVENT])
+        modeller = app.Modeller(topology, [(0, 0, 0)]*topology.getNumAtoms()*unit.nanometer)
+        modeller.delete([residue for residue in topology.residues() if residue.name in SOLVENT])
+        self._topology = modeller.topology
+        self._dcd = None
+        self._nextModel = 0
+        self._quantize = quantize
+        if not file.endswith('.dcd'):
+            if capacity is None:
+                raise ValueError("SoluteReporter needs a capacity to preallocate {}".format(file))
+            shape = (capacity, len(self._selection), 3)
+            dtype = np.int16 if quantize else np.float32
+            self._frames = np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=shape)
+            if quantize:
+                self._origins = np.lib.format.open_memmap(f'{file}.origin.npy', mode='w+', dtype=np.float32,
+                                                          shape=(capacity + 1, 3))
+                self._origins[capacity] = (quantize, 0, 0)
+
+    def describeNextReport(self, simulation):
+        """Get information about the next report this object will generate.
+
+        Parameters
+        ----------
+        simulation : Simulation
+            The Simulation to generate a report for
+
+        Returns
+        -------
+        tuple
+            A five element tuple. The first element is the number of steps
+            until the next report. The remaining elements specify whether
+            that report will require positions, velocities, forces, and
+            energies respectively.
+        """
+        steps = self._reportInterval - simulation.currentStep%self._reportInterval
+        return (steps, True, False, False, False)
+
+    def report(self, simulation, state):
+        """Generate a report.
+
+        Parameters
+        ----------
+        simulation : Simulation
+            The Simulation to generate a report for
+        state : State
+            The current state of the simulation
+        """
+        positions = state.getPositions(asNumpy=True).value_in_unit(unit.nanometer)[self._selection]
+        if self._nextModel == 0:
+            with open(f'{self._file}.pdb', 'w') as pdb:
+                app.PDBFile.writeFile(self._topology, positions*unit.nanometer, pdb)
+        if self._file.endswith('.dcd'):
+            if self._dcd is None:
+                self._out = open(self._file, 'wb')
+                self._dcd = app.DCDFile(self._out, self._topology, simulation.integrator.getStepSize(),
+                                        simulation.currentStep, self._reportInterval)
+            self._dcd.writeModel(positions*unit.nanometer, periodicBoxVectors=state.getPeriodicBoxVectors())
+        elif self._quantize:
+            origin = (positions.min(axis=0) + positions.max(axis=0)) / 2
+            fixed = np.round((positions - origin) / self._quantize)
+            if np.abs(fixed).max() > np.iinfo(np.int16).max:
+                raise ValueError("Solute spans {} nm, more than int16 holds at a resolution of {} nm".format(
+                    (positions.max(axis=0) - positions.min(axis=0)).max(), self._quantize))
+            self._origins[self._nextModel] = origin
+            self._frames[self._nextModel] = fixed
+        else:
+            self._frames[self._nextModel] = positions
+        self._nextModel += 1
+
+    def __del__(self):
+        if self._dcd is not None:
+            self._out.close()
+        elif hasattr(self, '_frames'):
+            self._frames.flush()
+
+
+def LoadFrames(file):
+    """
+    Returns the frames of a .npy SoluteReporter trajectory in nm, shape [frames, atoms, 3].
+    int16 trajectories are converted with the resolution stored in <file>.origin.npy.
+    """
+    frames = np.load(file, mmap_mode='r')
+    if frames.dtype != np.int16:
+        return frames
+    origins = np.load(f'{file}.origin.npy', mmap_mode='r')
+    quantize = origins[-1, 0]
+    return origins[:-1, None, :] + frames.astype(np.float32) * quantize
@@ -0,0 +1,199 @@
+"""
+Solvated receptor boxes for explicit solvent simulation, built once per receptor.
+The receptor is the same for every ligand, so it is solvated, minimized and briefly equilibrated
+  (heavy atoms restrained to the docked structure) only once. The box is kept as a PDBx file keyed
+  by the receptor prmtop/inpcrd and the settings. A complex is then set up by putting the docked
+  ligand into the box, removing the waters it overlaps and counterions to keep the box neutral.
+Box caching is opt-in: set $IMPRESS_SOLVENT_BOX to the directory the boxes are kept in, an
+  absolute path every rank shares. Unset, every system is solvated from scratch.
+"""
+import os
+import fcntl
+import numpy as np
+from simtk.openmm import app
+import simtk.openmm as mm
+from simtk import unit
+from . import platforms, timing
+
+FORCEFIELD_FILES = ('amber14-all.xml', 'amber14/tip3p.xml')
+PADDING = 1.4 # nm
+EQUILIBRATION_STEPS = 5000 # 10 ps
+OVERLAP = 0.25 # nm, waters and ions with an atom closer than this to the ligand are removed
+SOLVENT = {'HOH', 'WAT'}
+CATIONS = {'NA', 'K', 'LI', 'CS', 'RB'}
+ANIONS = {'CL', 'BR', 'F', 'IOD'}
+
+# One ForceField per process; parsing the amber14 XML files takes seconds.
+_forcefield = None
+
+def GetForceField():
+    global _forcefield
+    if _forcefield is None:
+        _forcefield = app.ForceField(*FORCEFIELD_FILES)
+    return _forcefield
+
+def Directory():
+    """
+    Returns $IMPRESS_SOLVENT_BOX, or None if it is unset or 'off'.
+    """
+    path = os.environ.get('IMPRESS_SOLVENT_BOX', '')
+    if path.lower() in ('', 'off', 'none'):
+        return None
+    return path
+
+def Solvate(topology, positions):
+    modeller = app.Modeller(topology, positions)
+    modeller.addSolvent(GetForceField(), padding=PADDING*unit.nanometer)
+    return modeller
+
+def EquilibratedBox(topology, positions):
+    """
+    Solvates topology, minimizes it and runs EQUILIBRATION_STEPS of MD with the solute heavy
+      atoms restrained. Returns the Modeller with the equilibrated positions and box.
+    """
+    modeller = Solvate(topology, positions)
+    system = GetForceField().createSystem(modeller.topology, nonbondedMethod=app.PME,
+                                          nonbondedCutoff=1.0*unit.nanometer, constraints=app.HBonds)
+    restraint = mm.CustomExternalForce('k*periodicdistance(x, y, z, x0, y0, z0)^2')
+    restraint.addGlobalParameter('k', 1000.0) # kJ/mol/nm^2
+    for name in ['x0', 'y0', 'z0']:
+        restraint.addPerParticleParameter(name)
+    for atom, position in zip(modeller.topology.atoms(), modeller.positions):
+        if atom.residue.name not in SOLVENT | CATIONS | ANIONS and atom.element is not None \
+                and atom.element.symbol != 'H':
+            restraint.addParticle(atom.index, position.value_in_unit(unit.nanometer))
+    system.addForce(restraint)
+    integrator = mm.LangevinIntegrator(300*unit.kelvin, 1.0/unit.picosecond, 0.002*unit.picosecond)
+    platform, properties = platforms.GetPlatform()
+    simulation = app.Simulation(modeller.topology, system, integrator, platform, properties)
+    simulation.context.setPositions(modeller.positions)
+    simulation.minimizeEnergy()
+    simulation.context.setVelocitiesToTemperature(300*unit.kelvin)
+    simulation.step(EQUILIBRATION_STEPS)
+    state = simulation.context.getState(getPositions=True, enforcePeriodicBox=True)
+    modeller.positions = state.getPositions()
+    modeller.topology.setPeriodicBoxVectors(state.getPeriodicBoxVectors())
+    return modeller
+
+def ReceptorBox(filepath, directory=None):
+    """
+    Returns a Modeller of the equilibrated solvent box around filepath.prmtop/.inpcrd (the receptor),
+      building it and writing it to the cache only the first time. One process builds a box
+      while the others wait on a lock file.
+    """
+    from .receptor_cache import SystemKey
+    directory = directory or Directory()
+    os.makedirs(directory, exist_ok=True)
+    key = SystemKey(f'{filepath}.prmtop', f'{filepath}.inpcrd', stage='solvent_box', padding=PADDING,
+                    equilibration=EQUILIBRATION_STEPS, forcefield=FORCEFIELD_FILES)
+    box_file = os.path.join(directory, f'{key}.cif')
+    if not os.path.exists(box_file):
+        with open(f'{box_file}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(box_file):
+                    prmtop = app.AmberPrmtopFile(f'{filepath}.prmtop')
+                    inpcrd = app.AmberInpcrdFile(f'{filepath}.inpcrd')
+                    with timing.Span('solvent_box'):
+                        modeller = EquilibratedBox(prmtop.topology, inpcrd.positions)
+                    tmp = f'{box_file}.{os.getpid()}.tmp'
+                    with open(tmp, 'w') as f:
+                        app.PDBxFile.writeFile(modeller.topology, modeller.positions, f, keepIds=True)
+                    os.replace(tmp, box_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    box = app.PDBxFile(box_file)
+    return app.Modeller(box.topology, box.positions)
+
+def NetCharge(prmtop, atoms):
+    """
+    Sum of the charges of the given atom indices in prmtop, rounded to an integer.
+    """
+    system = prmtop.createSystem()
+    nonbonded = [f for f in system.getForces() if isinstance(f, mm.NonbondedForce)][0]
+    charge = sum(nonbonded.getParticleParameters(i)[0].value_in_unit(unit.elementary_charge) for i in atoms)
+    return int(round(charge))
+
+def InsertLigand(box, filepath, n_receptor):
+    """
+    Returns a Modeller of the complex in filepath.prmtop/.inpcrd in the receptor box: receptor,
+      ligand, then the solvent, with the overlapping waters and ions removed. The charge left over
+      (ligand charge plus removed ions) is offset by removing further ions of its sign; if the box
+      has too few, the waters farthest from the ligand are replaced with ions of the opposite sign,
+      so the PME box stays neutral.
+    n_receptor is the number of receptor atoms, which come first in the complex.
+    """
+    prmtop = app.AmberPrmtopFile(f'{filepath}.prmtop')
+    inpcrd = app.AmberInpcrdFile(f'{filepath}.inpcrd')
+    ligand = app.Modeller(prmtop.topology, inpcrd.positions)
+    ligand.delete([r for r in ligand.topology.residues() if min(a.index for a in r.atoms()) < n_receptor])
+    ligand_xyz = np.array(ligand.positions.value_in_unit(unit.nanometer))
+
+    box_vectors = box.topology.getPeriodicBoxVectors()
+    lengths = np.array([box_vectors[i][i].value_in_unit(unit.nanometer) for i in range(3)])
+    xyz = np.array(box.positions.value_in_unit(unit.nanometer))
+    solvent = [r for r in box.topology.residues() if r.name in SOLVENT | CATIONS | ANIONS]
+
+    remove = []
+    for residue in solvent:
+        d = xyz[[a.index for a in residue.atoms()], None, :] - ligand_xyz[None, :, :]
+        d -= lengths * np.round(d / lengths)
+        if (np.sqrt((d**2).sum(axis=-1)) < OVERLAP).any():
+            remove.append(residue)
+    charge = NetCharge(prmtop, range(n_receptor, prmtop.topology.getNumAtoms()))
+    charge -= sum(1 for r in remove if r.name in CATIONS) - sum(1 for r in remove if r.name in ANIONS)
+    overlapping = set(r.index for r in remove)
+    counterions = [r for r in solvent if r.name in (CATIONS if charge > 0 else ANIONS)
+                   and r.index not in overlapping][:abs(charge)]
+    remove += counterions
+    ions = app.Topology()
+    ion_positions = []
+    missing = abs(charge) - len(counterions)
+    if missing > 0:
+        removed = set(r.index for r in remove)
+        center = ligand_xyz.mean(axis=0)
+        waters = []
+        for residue in solvent:
+            if residue.name in SOLVENT and residue.index not in removed:
+                oxygen = [a.index for a in residue.atoms() if a.element is not None and a.element.symbol == 'O'][0]
+                d = xyz[oxygen] - center
+                d -= lengths * np.round(d / lengths)
+                waters.append(((d**2).sum(), residue, oxygen))
+        waters.sort(key=lambda w: -w[0])
+        name, element = ('CL', app.element.chlorine) if charge > 0 else ('NA', app.element.sodium)
+        chain = ions.addChain()
+        for _, residue, oxygen in waters[:missing]:
+            ions.addAtom(name, element, ions.addResidue(name, chain))
+            ion_positions.append(xyz[oxygen])
+            remove.append(residue)
+        print("Replaced {} waters with {} to offset a charge of {}".format(min(missing, len(waters)), name, charge))
+
+    receptor = app.Modeller(box.topology, box.positions)
+    receptor.delete(solvent)
+    water = app.Modeller(box.topology, box.positions)
+    solvent_ids = set(r.index for r in solvent)
+    water.delete([r for r in box.topology.residues() if r.index not in solvent_ids] + remove)
+    receptor.add(ligand.topology, ligand.positions)
+    receptor.add(water.topology, water.positions)
+    if ion_positions:
+        receptor.add(ions, np.array(ion_positions)*unit.nanometer)
+    receptor.topology.setPeriodicBoxVectors(box_vectors)
+    return receptor
+
+def SolvatedSystem(filepath):
+    """
+    Returns a Modeller of the solvated system in filepath.prmtop/.inpcrd. apo and com (next to an
+      apo.prmtop) come from the cached receptor box, anything else is solvated from scratch.
+    """
+    directory = Directory()
+    path, name = os.path.split(filepath)
+    apo = os.path.join(path, 'apo')
+    if directory is not None and name in ('apo', 'com') and os.path.exists(f'{apo}.prmtop'):
+        box = ReceptorBox(apo, directory)
+        if name == 'apo':
+            return box
+        n_receptor = app.AmberPrmtopFile(f'{apo}.prmtop').topology.getNumAtoms()
+        return InsertLigand(box, filepath, n_receptor)
+    prmtop = app.AmberPrmtopFile(f'{filepath}.prmtop')
+    inpcrd = app.AmberInpcrdFile(f'{filepath}.inpcrd')
+    return Solvate(prmtop.topology, inpcrd.positions)
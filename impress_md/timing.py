@@ -0,0 +1,226 @@
+"""
+Where the time per ligand goes: spans around the stages and hot spots of the pipeline.
+A span records its name, start, duration, MPI rank, ligand and parent span. Spans are appended as
+  JSON lines to $IMPRESS_PROFILE/events.<host>.<pid>.jsonl, one file per process so ranks and pool
+  workers never share a file. Nothing is recorded unless $IMPRESS_PROFILE is set.
+$IMPRESS_PROFILE_SAMPLE=<ms> also runs a sampling profiler: a thread that records the Python stack
+  of the main thread every <ms> milliseconds and writes folded stacks (flamegraph.pl format) to
+  $IMPRESS_PROFILE/samples.<host>.<pid>.txt at exit.
+profile_report.py aggregates the files of all ranks.
+"""
+import os
+import sys
+import json
+import time
+import inspect
+import functools
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from multiprocessing import util
+
+_local = threading.local()
+_log = None
+_log_pid = None
+_sampler = None
+
+def Directory():
+    path = os.environ.get('IMPRESS_PROFILE', '')
+    if path.lower() in ('', 'off', 'none'):
+        return None
+    return path
+
+def Rank():
+    """
+    The MPI rank from the launcher's environment, without initializing MPI.
+    """
+    for name in ['OMPI_COMM_WORLD_RANK', 'PMI_RANK', 'PMIX_RANK', 'SLURM_PROCID']:
+        if name in os.environ:
+            return int(os.environ[name])
+    return 0
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def _writer():
+    """
+    Returns this process' event log, opening it (and starting the sampler) on first use.
+    """
+    global _log, _log_pid
+    if _log is None or _log_pid != os.getpid():
+        directory = Directory()
+        os.makedirs(directory, exist_ok=True)
+        _log = open(f'{directory}/events.{os.uname().nodename}.{os.getpid()}.jsonl', 'a', buffering=1)
+        _log_pid = os.getpid()
+        if os.environ.get('IMPRESS_PROFILE_SAMPLE'):
+            StartSampler(float(os.environ['IMPRESS_PROFILE_SAMPLE']) / 1000)
+    return _log
+
+@contextmanager
+def Ligand(ligand):
+    """
+    Tags every span opened inside with the ligand ID.
+    """
+    previous = getattr(_local, 'ligand', None)
+    _local.ligand = ligand
+    try:
+        yield
+    finally:
+        _local.ligand = previous
+
+@contextmanager
+def Span(name, **attributes):
+    """
+    Times the enclosed block as span name. attributes are recorded with it.
+    """
+    if Directory() is None:
+        yield
+        return
+    log = _writer()
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    start = time.time()
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - t
+        stack.pop()
+        event = {'name': name, 'start': start, 'dur': duration, 'rank': Rank(), 'pid': os.getpid(),
+                 'ligand': getattr(_local, 'ligand', None), 'parent': parent}
+        event.update(attributes)
+        log.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+def Timed(name):
+    """
+    Decorator form of Span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def Stage(name, path_arg):
+    """
+    Decorator for the stages in interface_functions: a Span tagged with the ligand, which is
+      the directory name (see results.LigandID) passed as argument path_arg.
+    """
+    def decorator(function):
+        signature = inspect.signature(function)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if Directory() is None:
+                return function(*args, **kwargs)
+            from .results import LigandID
+            path = signature.bind(*args, **kwargs).arguments.get(path_arg)
+            with Ligand(LigandID(path) if path is not None else None), Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def CheckOutput(command, **kwargs):
+    """
+    subprocess.check_output(command, shell=True) timed as a span named after the program.
+    """
+    import subprocess
+    with Span(command.split()[0]):
+        return subprocess.check_output(command, shell=True, **kwargs)
+
+class Sampler(threading.Thread):
+    """
+    Samples the stack of the main thread every interval seconds. The first span may be opened
+      from an executor thread, which is not where the time of a process goes.
+    """
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.target = threading.main_thread().ident
+        self.pid = os.getpid()
+        self.counts = Counter()
+        self.running = True
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def dump(self):
+        self.running = False
+        directory = Directory()
+        with open(f'{directory}/samples.{os.uname().nodename}.{os.getpid()}.txt', 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f'{stack} {count}\n')
+
+def StartSampler(interval=0.01):
+    global _sampler
+    if _sampler is None or _sampler.pid != os.getpid():
+        _sampler = Sampler(interval)
+        _sampler.start()
+        # Runs at exit in pool workers too, where atexit handlers do not
+        util.Finalize(None, _sampler.dump, exitpriority=10)
+    return _sampler
+
+def LoadEvents(directory):
+    """
+    Reads the spans of every process and rank written to directory.
+    """
+    import glob
+    events = []
+    for filename in sorted(glob.glob(f'{directory}/events.*.jsonl')):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # The last line of a process that was killed may be cut short
+                    pass
+    return events
+
+def Summarize(events, key='name'):
+    """
+    Returns [(group, count, total, mean, median, p95, max)] of the span durations grouped by
+      key ('name', 'rank', 'ligand' or a tuple of them), largest total first.
+    """
+    import numpy as np
+    keys = key if isinstance(key, tuple) else (key,)
+    groups = dict()
+    for event in events:
+        group = tuple(event.get(k) for k in keys)
+        groups.setdefault(group if len(keys) > 1 else group[0], []).append(event['dur'])
+    rows = []
+    for group, durations in groups.items():
+        d = np.array(durations)
+        rows.append((group, len(d), d.sum(), d.mean(), np.median(d), np.percentile(d, 95), d.max()))
+    return sorted(rows, key=lambda row: -row[2])
+
+def MergeSamples(directory, out_file):
+    """
+    Adds up the folded stacks of every process into out_file. Returns {function: samples} of
+      the innermost frames (where the time is spent), most sampled first.
+    """
+    import glob
+    stacks = Counter()
+    for filename in glob.glob(f'{directory}/samples.*.txt'):
+        with open(filename) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+    leaves = Counter()
+    with open(out_file, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write(f'{stack} {count}\n')
+            leaves[stack.rsplit(';', 1)[-1]] += count
+    return dict(leaves.most_common())
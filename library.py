@@ -0,0 +1,39 @@
+"""INSPIRE Library - Remove duplicate molecules before a screen and map results back afterwards
+
+Usage:
+  library.py dedup -i=<SMILES_FILE> -o=<PATH> -d=<DB> [-l=<NAME>] [--keep-salts] [--keep-tautomers]
+  library.py fanout -r=<RESULTS> -d=<DB> -o=<PATH> [-k=<KEY>] [-l=<NAME>]
+  library.py (-h | --help)
+  library.py --version
+
+Options:
+  -h --help         Show this screen.
+  --version         Show version.
+  -i=<SMILES_FILE>  Space separated library with a header line and SMILES in the first column.
+  -o=<PATH>         dedup: .smi of unique molecules to dispatch. fanout: per-row results table.
+  -d=<DB>           SQLite file mapping library rows to unique molecules.
+  -r=<RESULTS>      CSV of results for the unique molecules, e.g. scores.csv from docking.py -f.
+  -k=<KEY>          Column of <RESULTS> holding the unique molecule index [default: row].
+  -l=<NAME>         Name of the library in <DB>, so several libraries can share it. dedup defaults
+                    to the file name of <SMILES_FILE>; fanout to the only library in <DB>.
+  --keep-salts      Do not strip counterions and solvents.
+  --keep-tautomers  Do not collapse tautomers and protonation states.
+"""
+from docopt import docopt
+from impress_md import batch_dock, library
+import os
+import timeit
+start = timeit.default_timer()
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version='INSPIRE Library 0.0.1')
+    if arguments['dedup']:
+        ligands = batch_dock.ReadSmiles(arguments['-i'])
+        name = arguments['-l'] or os.path.basename(arguments['-i'])
+        count = library.WriteUnique(ligands, arguments['-d'], arguments['-o'], name,
+                                    strip_salts=not arguments['--keep-salts'],
+                                    tautomer=not arguments['--keep-tautomers'])
+        print("Wrote {} unique molecules to {}".format(count, arguments['-o']))
+    else:
+        library.FanOut(arguments['-r'], arguments['-d'], arguments['-o'], arguments['-k'], arguments['-l'])
+    print("Execution time (sec): {}".format(timeit.default_timer() - start))
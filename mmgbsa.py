@@ -1,7 +1,7 @@
 """INSPIRE MMGBSA Calculator - Computed bind free energy estimates *fairly* cheaply.
 
 Usage:
-  mmgbsa.py -p=<STRUCTURES> [-n=<NANOSECONDS>] [-r=<REPLICAS>] [-m]
+  mmgbsa.py -p=<STRUCTURES> [-n=<NANOSECONDS>] [-r=<REPLICAS>] [-m] [-c=<ITERATIONS>] [-j]
   mmgbsa.py (-h | --help)
   mmgbsa.py --version
 
@@ -11,7 +11,12 @@ Options:
   -p=<STRUCTURES>   Path to files containing AMBER format topology and coordinates of the protein, ligand and complex.
   -n=<NANOSECONDS>  Trajectory length of simulation to run (0 = minimization alone) [default=0].
   -r=<REPLICAS>     Number of replica simulations to execute [default=1]. NOT CURRENTLY IN USE
-  -m                Minimize components independently. CURRENTLY ALWAYS TRUE
+  -m                Single-trajectory mode: only the complex is minimized or simulated, and the
+                    receptor and ligand energies are evaluated on its coordinates.
+  -c=<ITERATIONS>   Checkpoint every this many ps of simulation and resume from the checkpoint
+                    when restarted, 0 to turn off [default: 100].
+  -j                Run the ligand, receptor and complex simulations concurrently in separate processes,
+                    splitting the GPUs in IMPRESS_DEVICE or the CPU threads between them.
 
 """
 from docopt import docopt
@@ -30,7 +35,7 @@ if __name__ == '__main__':
             logf.write("Execution time (sec): {}\n".format(timeit.default_timer() - start))
     else:
         niter = round(float(arguments['-n'])*1000)
-        interface_functions.RunMMGBSA(path, path, niter)
+        interface_functions.RunMMGBSA(path, path, niter, one_traj, int(arguments['-c']), arguments['-j'])
         with open(f'{path}/mmgbsa.log',"w+") as logf:
             logf.write("Execution time (sec): {}\n".format(timeit.default_timer() - start))
 
@@ -1,7 +1,8 @@
 """INSPIRE Parameterization - Parameterize a docked ligand-protein system
 
 Usage:
-  param.py -i=<PATH> [-a]
+  param.py -i=<PATH> [-a] [-r]
+  param.py -f=<DIRS> [-j=<WORKERS>] [-r]
   param.py (-h | --help)
   param.py --version
 
@@ -10,6 +11,11 @@ Options:
   --version     Show version.
   -i=<PATH>     Path to directory containing a PDBs of the ligand, receptor, and complex.
   -a            Parameterize the docked system with AMBER [default uses OpenEye].
+  -f=<DIRS>     File with one ligand directory per line, parameterized with OpenEye.
+  -j=<WORKERS>  Number of processes charging ligands ahead of the antechamber/tleap steps [default: 2].
+  -r            Parameterize the receptor only once (kept in IMPRESS_RECEPTOR_PARAMS, default receptor_params/)
+                and build the complex with ParmEd instead of running tleap on it for every ligand.
+                Experimental: the first complex per receptor is checked against a full tleap build.
 
 """
 from docopt import docopt
@@ -21,10 +27,16 @@ if __name__ == '__main__':
     arguments = docopt(__doc__, version='INSPIRE Param 0.0.1')
     path = arguments['-i']
     
-    if arguments['-a']:
-        interface_functions.ParameterizeAMBER(path)
+    if arguments['-f']:
+        with open(arguments['-f']) as f:
+            paths = [line.strip() for line in f if line.strip()]
+        failed = interface_functions.ParameterizeMany(paths, int(arguments['-j']), arguments['-r'] or None)
+        print("Parameterized {} of {} ligands".format(len(paths) - len(failed), len(paths)))
+        path = '.'
+    elif arguments['-a']:
+        interface_functions.ParameterizeAMBER(path, arguments['-r'] or None)
     else:
-        interface_functions.ParameterizeOE(path)
+        interface_functions.ParameterizeOE(path, arguments['-r'] or None)
 
 with open(f'{path}/param.log',"w+") as logf:
     logf.write("Param time (sec): {}\n".format(timeit.default_timer() - start))
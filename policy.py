@@ -7,26 +7,92 @@ class DockPolicy():
     def __call__(self, smile):
         return True
 
-class MinimizePolicy():
-    def __init__(self):
-        self.buffer = np.zeros(10)
-        self.buffer_sat = True
+    def decide_many(self, smiles):
+        return np.ones(len(smiles), dtype=bool)
+
+class WindowQuantile():
+    """
+    Exact quantiles over the last `window` values.
+    Values are kept in arrival order (a ring buffer, to know which value leaves the window) and
+      in sorted order, so a quantile is an index lookup. A batch of k values is merged with one
+      searchsorted and one insert/delete, O(k log window) plus one memmove of the window.
+    """
+    def __init__(self, window=100000):
+        self.window = window
+        self.ring = np.zeros(window)
+        self.sorted = np.zeros(0)
         self.pos = 0
-        
+        self.count = 0
+
+    def update(self, value):
+        self.update_many([value])
+
+    def update_many(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)][-self.window:]
+        n = len(values)
+        if n == 0:
+            return
+
+        # Drop the values that fall out of the window
+        n_out = max(0, self.count + n - self.window)
+        if n_out:
+            old = np.sort(self.ring[(self.pos - self.count + np.arange(n_out)) % self.window])
+            # Equal values map to the same left index; offset each by its position among its duplicates
+            dup = np.arange(n_out) - np.searchsorted(old, old, side='left')
+            self.sorted = np.delete(self.sorted, np.searchsorted(self.sorted, old, side='left') + dup)
+
+        new = np.sort(values)
+        self.sorted = np.insert(self.sorted, np.searchsorted(self.sorted, new), new)
+        self.ring[(self.pos + np.arange(n)) % self.window] = values
+        self.pos = (self.pos + n) % self.window
+        self.count = min(self.count + n, self.window)
+
+    def quantile(self, q):
+        """
+        Same interpolation as np.quantile (linear) over the current window.
+        """
+        if self.count == 0:
+            return np.nan
+        x = q * (self.count - 1)
+        lo = int(np.floor(x))
+        hi = min(lo + 1, self.count - 1)
+        return self.sorted[lo] + (x - lo) * (self.sorted[hi] - self.sorted[lo])
+
+class MinimizePolicy():
+    """
+    Minimize a ligand if its docking score is in the best (lowest) `quantile` of the last
+      `window` docking scores. Until `min_samples` scores have been seen every ligand passes.
+    """
+    def __init__(self, window=100000, quantile=0.1, min_samples=10):
+        self.sketch = WindowQuantile(window)
+        self.quantile = quantile
+        self.min_samples = min_samples
+
+    def threshold(self):
+        return self.sketch.quantile(self.quantile)
 
     def __call__(self, smile, dockscore):
-        v = True
+        return bool(self.decide_many([smile], [dockscore])[0])
 
-        if self.buffer_sat:
-            print("cur buf", np.quantile(self.buffer, 0.1))
-            v =  dockscore <= np.quantile(self.buffer, 0.1)
+    def update_many(self, dockscores):
+        self.sketch.update_many(dockscores)
 
-        self.buffer[self.pos] = dockscore
-        self.pos = (self.pos + 1) % 10
-        if self.pos == 0:
-            self.buffer_sat = True
-        
+    def decide_many(self, smiles, dockscores):
+        """
+        Batched __call__. Every score in the batch is compared to the threshold of the window
+        as it was before the batch, then the whole batch is added to the window.
+        """
+        dockscores = np.asarray(dockscores, dtype=float)
+        if self.sketch.count >= self.min_samples:
+            v = dockscores <= self.threshold()
+        else:
+            v = np.ones(len(dockscores), dtype=bool)
+        self.update_many(dockscores)
         return v
-        
+
 def mmgbsa_ns_policy(smile, dock_score, minimize_score):
     return False
+
+def mmgbsa_ns_policy_many(smiles, dock_scores, minimize_scores):
+    return np.zeros(len(smiles), dtype=bool)
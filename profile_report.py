@@ -0,0 +1,55 @@
+"""INSPIRE Profile Report - Where the time per ligand goes, over all ranks
+
+Usage:
+  profile_report.py -d=<DIR> [--by=<KEYS>] [-n=<NUM>] [-o=<CSV>]
+  profile_report.py (-h | --help)
+  profile_report.py --version
+
+Options:
+  -h --help         Show this screen.
+  --version         Show version.
+  -d=<DIR>          Directory the pipeline was run with as IMPRESS_PROFILE.
+  --by=<KEYS>       Comma separated span fields to group by: name, rank, ligand, parent [default: name].
+  -n=<NUM>          Number of rows and sampled functions to print [default: 30].
+  -o=<CSV>          Also write the full table to this CSV.
+
+Spans come from the events.*.jsonl files of every rank and pool worker. When the run used
+IMPRESS_PROFILE_SAMPLE, the sampled stacks of all processes are merged into <DIR>/samples.folded
+(input for flamegraph.pl) and the most sampled functions are printed.
+"""
+from docopt import docopt
+from impress_md import timing
+import os
+import csv
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version='INSPIRE Profile Report 0.0.1')
+    directory = arguments['-d']
+    keys = tuple(arguments['--by'].split(','))
+    num = int(arguments['-n'])
+    events = timing.LoadEvents(directory)
+    ranks = set(event['rank'] for event in events)
+    ligands = set(event['ligand'] for event in events if event['ligand'] is not None)
+    print("{} spans from {} ranks, {} ligands".format(len(events), len(ranks), len(ligands)))
+
+    rows = timing.Summarize(events, keys if len(keys) > 1 else keys[0])
+    print("{:<40s} {:>8s} {:>12s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+        ','.join(keys), 'count', 'total (s)', 'mean', 'median', 'p95', 'max'))
+    for group, count, total, mean, median, p95, longest in rows[:num]:
+        print("{:<40s} {:>8d} {:>12.2f} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}".format(
+            str(group), count, total, mean, median, p95, longest))
+    if ligands and keys == ('name',):
+        print("Per ligand (s): " + ", ".join("{} {:.2f}".format(group, total / len(ligands))
+                                             for group, count, total, *_ in rows[:num]))
+    if arguments['-o']:
+        with open(arguments['-o'], 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(keys) + ['count', 'total', 'mean', 'median', 'p95', 'max'])
+            for group, *stats in rows:
+                writer.writerow((list(group) if len(keys) > 1 else [group]) + stats)
+
+    if any(name.startswith('samples.') for name in os.listdir(directory)):
+        leaves = timing.MergeSamples(directory, f'{directory}/samples.folded')
+        print("Most sampled functions (samples):")
+        for function, count in list(leaves.items())[:num]:
+            print("  {:<60s} {}".format(function, count))
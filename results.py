@@ -0,0 +1,33 @@
+"""INSPIRE Results - Rank and export a campaign from the results store
+
+Usage:
+  results.py export -d=<DB> -o=<CSV> [-m=<METRICS>]
+  results.py top -d=<DB> -m=<METRIC> [-n=<NUM>] [--desc]
+  results.py (-h | --help)
+  results.py --version
+
+Options:
+  -h --help         Show this screen.
+  --version         Show version.
+  -d=<DB>           Results store written by the pipeline with IMPRESS_RESULTS=<DB>.
+  -o=<CSV>          Table with one row per ligand and a column per metric.
+  -m=<METRICS>      export: comma separated metrics to include (default all). top: metric to rank by.
+  -n=<NUM>          Number of ligands to show [default: 100].
+  --desc            Rank highest first (default lowest first, as for energies).
+"""
+from docopt import docopt
+from impress_md import results
+import timeit
+start = timeit.default_timer()
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version='INSPIRE Results 0.0.1')
+    store = results.ResultsStore(arguments['-d'])
+    if arguments['export']:
+        metrics = arguments['-m'].split(',') if arguments['-m'] else None
+        count = store.export(arguments['-o'], metrics)
+        print("Wrote {} ligands to {}".format(count, arguments['-o']))
+    else:
+        for ligand, value in store.top(arguments['-m'], int(arguments['-n']), arguments['--desc']):
+            print(ligand, value)
+    print("Execution time (sec): {}".format(timeit.default_timer() - start))
@@ -1,85 +1,319 @@
+"""INSPIRE Runner - Screen a SMILES library over MPI
+
+Usage:
+  runner.py <SMILES_FILE> [-c=<CHUNK>] [-w=<WINDOW>] [-p] [--dock=<N>] [--param=<N>] [--md=<N>] [--depth=<N>]
+  runner.py (-h | --help)
+
+Options:
+  -h --help     Show this screen.
+  -c=<CHUNK>    Number of ligands handed to a worker per request [default: 1].
+  -w=<WINDOW>   Number of recent docking scores the minimize policy takes its quantile over [default: 100000].
+  -p            Pipelined workers: docking, parameterization and OpenMM stages of different ligands overlap.
+  --dock=<N>    Pipelined mode: concurrent docking processes per rank [default: 1].
+  --param=<N>   Pipelined mode: concurrent parameterization processes per rank [default: 1].
+  --md=<N>      Pipelined mode: concurrent OpenMM processes per rank [default: 1].
+  --depth=<N>   Pipelined mode: ligands allowed to wait in front of each stage [default: 2].
+
+Rank 0 serves the policies and hands out ligands; all other ranks pull work until the library is exhausted.
+"""
+import mpi4py
+# MPI is initialized explicitly, after the pipelined worker has forked its process pools:
+# fork after MPI_Init is not supported by OpenMPI over verbs/UCX, and the children inherit MPI state.
+mpi4py.rc.initialize = False
+mpi4py.rc.finalize = True
 from mpi4py import MPI
+from docopt import docopt
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
 import sys
 import policy
 from impress_md import interface_functions
 
 comm = MPI.COMM_WORLD
-rank = comm.Get_rank()
+rank = None # set once MPI is initialized
 
+# Every message carries its pipeline stage in the tag. Replies come back on the same tag.
+WORK_TAG = 12     # worker -> server: None, server -> worker: [(pos, smiles, dock decision)]
+MINIMIZE_TAG = 22 # worker -> server: (smiles, dock score), server -> worker: decision
+MMGBSA_TAG = 23   # worker -> server: (smiles, dock score, minimize score), server -> worker: decision
+DONE_TAG = 13     # worker -> server: None, once the worker has finished every ligand it pulled; no reply
 
 
-def setup_server():
-    status_ = MPI.Status()
-    storage = {}
+def next_chunk(df, start, chunk_size):
+    stop = min(start + chunk_size, len(df))
+    return [(pos, df.iloc[pos,0]) for pos in range(start, stop)]
+
+
+class PolicyServer():
+    """
+    Serves work and policy decisions to all other ranks.
+    One irecv is kept posted per worker. Whenever one completes, every other message that has
+      already arrived is collected too, and the policies are evaluated once per stage on the whole batch.
+    The docking decision is made when a ligand is handed out and travels with the chunk,
+      so workers never wait on the server before docking.
+    A worker stays active until it sends DONE, not when it is handed an empty chunk: a pipelined
+      worker still has ligands in flight then, and will ask for their policy decisions.
+    """
+    def __init__(self, df, chunk_size=1, window=100000, buffer_size=1<<16):
+        self.df = df
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.next_pos = 0
+        self.dockPolicy = policy.DockPolicy()
+        self.mmPolicy = policy.MinimizePolicy(window)
+        self.sources = list(range(1, comm.Get_size()))
+        self.requests = [self.post(source) for source in self.sources]
+        self.active_workers = len(self.sources)
+
+    def post(self, source):
+        return comm.irecv(bytearray(self.buffer_size), source=source, tag=MPI.ANY_TAG)
+
+    def gather(self):
+        """
+        Blocks for one message, then drains whatever else is waiting. Returns [(source, tag, data)].
+        """
+        batch = []
+        status = MPI.Status()
+        index, data = MPI.Request.waitany(self.requests, status)
+        while True:
+            batch.append((self.sources[index], status.Get_tag(), data))
+            self.requests[index] = self.post(self.sources[index])
+            status = MPI.Status()
+            index, flag, data = MPI.Request.testany(self.requests, status)
+            if not flag:
+                return batch
+
+    def serve(self):
+        while self.active_workers > 0:
+            batch = self.gather()
+            sends = []
+            sends += self.handle_work([m for m in batch if m[1] == WORK_TAG])
+            sends += self.handle_minimize([m for m in batch if m[1] == MINIMIZE_TAG])
+            sends += self.handle_mmgbsa([m for m in batch if m[1] == MMGBSA_TAG])
+            self.active_workers -= sum(1 for m in batch if m[1] == DONE_TAG)
+            for source, tag, data in batch:
+                if tag not in (WORK_TAG, MINIMIZE_TAG, MMGBSA_TAG, DONE_TAG):
+                    print("got some weird data", tag, data)
+            MPI.Request.waitall(sends)
+        for request in self.requests:
+            request.Cancel()
+
+    def handle_work(self, batch):
+        chunks = []
+        for source, tag, data in batch:
+            chunk = next_chunk(self.df, self.next_pos, self.chunk_size)
+            self.next_pos += len(chunk)
+            chunks.append(chunk)
+        decisions = iter(self.dockPolicy.decide_many([smiles for chunk in chunks for pos, smiles in chunk]))
+        return [comm.isend([(pos, smiles, bool(next(decisions))) for pos, smiles in chunk], dest=source, tag=WORK_TAG)
+                for (source, tag, data), chunk in zip(batch, chunks)]
+
+    def handle_minimize(self, batch):
+        if not batch:
+            return []
+        smiles, scores = zip(*[data for source, tag, data in batch])
+        decisions = self.mmPolicy.decide_many(smiles, scores)
+        return [comm.isend(bool(r), dest=source, tag=MINIMIZE_TAG) for (source, tag, data), r in zip(batch, decisions)]
+
+    def handle_mmgbsa(self, batch):
+        if not batch:
+            return []
+        smiles, dock_scores, minimize_scores = zip(*[data for source, tag, data in batch])
+        decisions = policy.mmgbsa_ns_policy_many(smiles, dock_scores, minimize_scores)
+        return [comm.isend(bool(r), dest=source, tag=MMGBSA_TAG) for (source, tag, data), r in zip(batch, decisions)]
 
-    dockPolicy = policy.DockPolicy()
-    mmPolicy = policy.MinimizePolicy()
-    while True:
-        
-        data = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status_)
-        if len(data) == 1: #pipeline 1
-            res = dockPolicy(*data)
-            comm.send(int(res), dest=status_.Get_source(), tag=11)
-        elif len(data) == 2: #pipeline 2
-            res = mmPolicy(*data)
-            comm.send(int(res), dest=status_.Get_source(), tag=11)
-        elif len(data) == 3: #pipline 3
-            res = policy.mmgbsa_ns_policy(data[0], data[1], data[2])
-            comm.send(int(res), dest=status_.Get_source(), tag=11)
-        else:
-            print("got some weird data", data)
-            
-
-def worker(df):
-    
-    struct = "input/"
-
-    start_pos = rank * 100
-    for pos in range(start_pos, 100 + start_pos):
-        path = "test" + str(pos)  + "/"
-        smiles = df.iloc[pos,0]
-   
-    
-        # pipline
-        comm.send([smiles], dest=0, tag=11)
-        r = comm.recv(source=0, tag=11)
-        print("Rank", rank, "should I run docking on", smiles,"?", "\t my model says", bool(r))
+
+def setup_server(df, chunk_size=1, window=100000):
+    PolicyServer(df, chunk_size, window).serve()
+
+
+def ask(tag, data):
+    comm.send(data, dest=0, tag=tag)
+    return comm.recv(source=0, tag=tag)
+
+
+def done():
+    comm.send(None, dest=0, tag=DONE_TAG)
+
+
+def run_ligand(pos, smiles, r, struct="input/"):
+    """
+    r is the docking decision rank 0 sent along with the ligand.
+    """
+    path = "test" + str(pos)  + "/"
+
+    # pipline
+    print("Rank", rank, "should I run docking on", smiles,"?", "\t my model says", bool(r))
+
+    # pipeline
+    if r:
+        print("Rank", rank, "running docking...")
+        score = interface_functions.RunDocking_(smiles,struct,path)
+        r = ask(MINIMIZE_TAG, (smiles, score))
+        print("Rank", rank, "should I run minimize, given the docking score", score, "?", "\t my model says", bool(r))
 
         # pipeline
         if r:
-            print("Rank", rank, "running docking...")
-            score = interface_functions.RunDocking_(smiles,struct,path)
-            comm.send([smiles, score], dest=0, tag=11)
-            r = comm.recv(source=0, tag=11)
-            print("Rank", rank, "should I run minimize, given the docking score", score, "?", "\t my model says", bool(r))
-        
-            # pipeline
+            print("Rank", rank, "running param and mini")
+            interface_functions.ParameterizeOE(path)
+            mscore = interface_functions.RunMinimization_(path, path)
+
+
+            r = ask(MMGBSA_TAG, (smiles, score, mscore))
+            print("Rank", rank, "should I run mmgbsa for 1 ns given a energy minmization result of", mscore, "?\t my model says", bool(r))
             if r:
-                print("Rank", rank, "running param and mini")
-                interface_functions.ParameterizeOE(path)
-                mscore = interface_functions.RunMinimization_(path, path)
-            
-            
-                comm.send([smiles, score, mscore], dest=0, tag=11)
-                r = comm.recv(source=0, tag=11)
-                print("Rank", rank, "should I run mmgbsa for 1 ns given a energy minmization result of", mscore, "?\t my model says", bool(r))
-                if r:
-                    print("Rank", rank, "running simulation")
-                    escore = interface_functions.RunMMGBSA_(path,path)
-                    print("Rank", rank, "ran simulation and got", escore)
-        
+                print("Rank", rank, "running simulation")
+                escore = interface_functions.RunMMGBSA_(path,path)
+                print("Rank", rank, "ran simulation and got", escore)
+
+
+def worker():
+    # Pull chunks of (position, smiles, dock decision) from rank 0 until it sends an empty one
+    while True:
+        chunk = ask(WORK_TAG, None)
+        if not chunk:
+            break
+        for pos, smiles, r in chunk:
+            run_ligand(pos, smiles, r)
+    done()
+
+
+
+def noop():
+    return None
+
+
+class PipelinedWorker():
+    """
+    Runs the same pipeline as run_ligand, but every stage has its own process pool and queue,
+      so one ligand can dock while another is parameterized and a third runs in OpenMM.
+    Policy questions are asked from this (main) thread as stages finish; MPI is never used by the pools.
+    New ligands are only pulled from rank 0 while every stage queue holds fewer than depth ligands.
+    minimize and mmgbsa share the md pool and its limit of md processes.
+    start() forks the worker processes of every pool; it has to be called before MPI.Init.
+    """
+    STAGES = ['dock', 'param', 'minimize', 'mmgbsa']
+    SLOTS = {'dock': 'dock', 'param': 'param', 'minimize': 'md', 'mmgbsa': 'md'}
+
+    def __init__(self, dock=1, param=1, md=1, depth=2, struct="input/"):
+        self.struct = struct
+        self.depth = depth
+        self.limits = {'dock': dock, 'param': param, 'md': md}
+        md_pool = ProcessPoolExecutor(md)
+        self.pools = {'dock': ProcessPoolExecutor(dock), 'param': ProcessPoolExecutor(param),
+                      'minimize': md_pool, 'mmgbsa': md_pool}
+        self.queues = {stage: deque() for stage in self.STAGES}
+        self.running = {}  # future -> (stage, ligand)
+        self.chunk = deque()
+        self.exhausted = False
+
+    def start(self):
+        # ProcessPoolExecutor forks all of its workers on the first submit and never forks again
+        wait([pool.submit(noop) for pool in set(self.pools.values())])
+
+    def shutdown(self):
+        for pool in set(self.pools.values()):
+            pool.shutdown()
+
+    def count(self, slot):
+        return sum(1 for s, ligand in self.running.values() if self.SLOTS[s] == slot)
+
+    def submit(self, stage, ligand):
+        path = ligand['path']
+        if stage == 'dock':
+            args = (interface_functions.RunDocking_, ligand['smiles'], self.struct, path)
+        elif stage == 'param':
+            args = (interface_functions.ParameterizeOE, path)
+        elif stage == 'minimize':
+            args = (interface_functions.RunMinimization_, path, path)
+        else:
+            args = (interface_functions.RunMMGBSA_, path, path)
+        self.running[self.pools[stage].submit(*args)] = (stage, ligand)
+
+    def pull(self):
+        # Refill from rank 0 while there is room in front of every stage
+        while not self.exhausted and all(len(q) < self.depth for q in self.queues.values()):
+            if not self.chunk:
+                chunk = ask(WORK_TAG, None)
+                if not chunk:
+                    self.exhausted = True
+                    break
+                self.chunk.extend(chunk)
+            pos, smiles, r = self.chunk.popleft()
+            print("Rank", rank, "should I run docking on", smiles,"?", "\t my model says", bool(r))
+            if r:
+                self.queues['dock'].append({'pos': pos, 'smiles': smiles, 'path': "test" + str(pos) + "/"})
+
+    def schedule(self):
+        for stage in self.STAGES:
+            slot = self.SLOTS[stage]
+            while self.queues[stage] and self.count(slot) < self.limits[slot]:
+                self.submit(stage, self.queues[stage].popleft())
+
+    def advance(self, future):
+        stage, ligand = self.running.pop(future)
+        smiles = ligand['smiles']
+        try:
+            result = future.result()
+        except Exception as e:
+            print("Rank", rank, stage, "failed for", smiles, e)
+            return
+        if stage == 'dock':
+            ligand['score'] = result
+            r = ask(MINIMIZE_TAG, (smiles, result))
+            print("Rank", rank, "should I run minimize, given the docking score", result, "?", "\t my model says", bool(r))
+            if r:
+                self.queues['param'].append(ligand)
+        elif stage == 'param':
+            self.queues['minimize'].append(ligand)
+        elif stage == 'minimize':
+            r = ask(MMGBSA_TAG, (smiles, ligand['score'], result))
+            print("Rank", rank, "should I run mmgbsa for 1 ns given a energy minmization result of", result, "?\t my model says", bool(r))
+            if r:
+                self.queues['mmgbsa'].append(ligand)
+        else:
+            print("Rank", rank, "ran simulation and got", result)
+
+    def run(self):
+        while True:
+            self.pull()
+            self.schedule()
+            if not self.running:
+                if self.exhausted and not any(self.queues.values()):
+                    break
+                continue
+            done, _ = wait(list(self.running), return_when=FIRST_COMPLETED)
+            for future in done:
+                self.advance(future)
+        self.shutdown()
+        done()
+
 
 
 
 if __name__ == '__main__':
-    df = pd.read_csv(sys.argv[1], sep=' ')
-    
+    arguments = docopt(__doc__)
+
+    pipelined = None
+    if arguments['-p']:
+        # The rank is not known before MPI.Init, so every rank forks its pools; rank 0 closes them again
+        pipelined = PipelinedWorker(int(arguments['--dock']), int(arguments['--param']),
+                                    int(arguments['--md']), int(arguments['--depth']))
+        pipelined.start()
+    MPI.Init()
+    rank = comm.Get_rank()
+
     if rank == 0:
-        setup_server()
+        if pipelined is not None:
+            pipelined.shutdown()
+        df = pd.read_csv(arguments['<SMILES_FILE>'], sep=' ')
+        setup_server(df, int(arguments['-c']), int(arguments['-w']))
+    elif pipelined is not None:
+        pipelined.run()
     else:
-        worker(df)
+        worker()
+
+
 
-        
 
-    
@@ -1,7 +1,7 @@
 """INSPIRE MD Simulator - Compute potential energy of the system solvated with explicit water.
 
 Usage:
-  sim.py -i=<STRUCTURES> [-o=<TRAJECTORY>] [-c=<COMPONENT>] [-n=<NANOSECONDS>]
+  sim.py -i=<STRUCTURES> [-o=<TRAJECTORY>] [-c=<COMPONENT>] [-n=<NANOSECONDS>] [--full]
   sim.py (-h | --help)
   sim.py --version
 
@@ -12,6 +12,8 @@ Options:
   -o=<TRAJECTORY>   Path to output files (trajectory, energy, temp, etc.) of the simulation [default=same as input path].
   -c=<COMPONENT>    Component (complex=com, protein=apo and ligand=lig) which needs to be simulated [default=com].
   -n=<NANOSECONDS>  Length of simulation to run in nanoseconds (0 = minimization alone) [default=0].
+  --full            Also write the whole system, water included, to traj.dcd. By default only the solute
+                    is written, to solute.dcd with its topology in solute.dcd.pdb.
 
 """
 from docopt import docopt
@@ -33,7 +35,7 @@ if __name__ == '__main__':
     else:
         nsteps = round(float(arguments['-n'])*500000)  # assuming timestep of 2 fs
 
-    potential = interface_functions.Simulation_explicit(inpath, outpath, nsteps, comp)
+    potential = interface_functions.Simulation_explicit(inpath, outpath, nsteps, comp, arguments['--full'])
     with open(f'{outpath}/simulation_explicit.log',"w+") as logf:
         logf.write("Mean potential energy of the simulated system is {} kJ/mol.\n".format(potential))
         logf.write("Execution time (sec): {}\n".format(timeit.default_timer() - start))